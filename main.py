@@ -1,22 +1,27 @@
+import time as time_lib
+STARTUP_TIME = time_lib.perf_counter() # Used for the startup timing report
+
 import tkinter as tk
 import tkinter.ttk as ttk
-from tkVideoPlayer import TkinterVideo
 import os
+import sys
+import signal
 import threading
 import tkinter.filedialog
 import tkinter.messagebox
 import pathlib
 import math
-from src import dbutils, camutils, settings
+from src import dbutils, camutils, settings, startutils, metricutils, schedutils
 from matplotlib import pyplot as plt
 from matplotlib.backends import backend_tkagg as plt_backend
 import datetime
-import time as time_lib
 import matplotlib.dates as plt_dates
 import numpy as np
 import re
+IMPORTS_TIME = time_lib.perf_counter()
 
 INF = int(1e20)
+LOADING_POLL_MS = 50 # How often the statistics tab checks whether its data is loaded
 
 class MainApp(tk.Tk):
     def __init__(self, title='Fox spy', *args, **kwargs):
@@ -25,8 +30,10 @@ class MainApp(tk.Tk):
         self.settings = settings.Settings()
 
         self.cam_end = threading.Event()
-        self.db = dbutils.Database()
+        self.db = dbutils.open_database(self.settings.get('Database backend'))
         self.cam_thread = None
+        self.classifier_service = None # Shared by all cameras, created with the first one
+        self.start_metrics()
         if self.settings.get('Autostart camera'):
             self.start_camera()
 
@@ -47,13 +54,42 @@ class MainApp(tk.Tk):
         self.currentTab = StatisticsMenu(self, self.settings, self.db)
         self.currentTab.grid(row=0, column=1)
 
+    # Starts exporting pipeline metrics to a json file and/or over HTTP if turned on in settings
+    def start_metrics(self):
+        self.stats_writer = None
+        self.metrics_server = None
+        if self.settings.get('Stats file'):
+            self.stats_writer = metricutils.StatsFileWriter(metricutils.metrics, self.settings.get('Stats file'))
+            self.stats_writer.start()
+        if self.settings.get('Stats port'):
+            self.metrics_server = metricutils.MetricsServer(metricutils.metrics, metricutils.profiler,
+                                                            int(self.settings.get('Stats port')))
+            self.metrics_server.start()
+        # "kill -USR1 <pid>" switches the profiler on and off
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: metricutils.profiler.toggle())
+
     # Starts the camera if it's not working
     def start_camera(self):
         if self.cam_thread == None or not self.cam_thread.is_alive():
             rtsp_url = self.settings.get("Camera url")
             start_time = datetime.datetime.strptime(self.settings.get("Camera start time"), "%H:%M")
             end_time = datetime.datetime.strptime(self.settings.get("Camera end time"), "%H:%M")
-            self.cam = camutils.Camera(rtsp_url, self.db, start_time, end_time, log=True)
+            if self.classifier_service is None:
+                model_path = self.settings.get("Exported model") # Empty to use NN.pkl through fastai
+                classifier = camutils.Classifier(model_path=model_path)
+                self.classifier_service = camutils.ClassifierService(classifier, log=True)
+            crop = tuple(int(pixels) for pixels in self.settings.get("Camera crop").split(','))
+            # Several working windows, e.g. "23:00-6:00; Sat,Sun 12:00-14:00". Empty to use start and end time
+            schedule_text = self.settings.get("Camera schedule")
+            try:
+                schedule = schedutils.Schedule.parse(schedule_text) if schedule_text else None
+            except ValueError as e:
+                # The settings file could have been edited by hand
+                print(f"Invalid camera schedule, using start and end time instead: {e}")
+                schedule = None
+            self.cam = camutils.Camera(rtsp_url, self.db, start_time, end_time, log=True,
+                                       classifier=self.classifier_service, crop=crop, schedule=schedule)
 
             self.cam_thread = threading.Thread(target=self.cam.start, args=(self.cam_end,))
             self.cam_end.clear()
@@ -94,6 +130,13 @@ class MainApp(tk.Tk):
         if self.cam_thread:
             self.cam_end.set()
             self.cam_thread.join()
+        if self.classifier_service:
+            self.classifier_service.stop()
+        if self.stats_writer:
+            self.stats_writer.stop()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        self.db.close()
 
 
 # Main menu in top left corner
@@ -123,6 +166,17 @@ class StatisticsMenu(tk.Frame):
         self.labels = ['Fox', 'Cat']
         self.y_axs = []
 
+        # Data is loaded and aggregated by a worker thread, the plot is drawn when poll_loading finds the result
+        # Every Update click gets a new request id. Only the latest request is loaded, older ones are dropped
+        self.load_lock = threading.Condition()
+        self.request_id = 0
+        self.pending = None # (request id, arguments of plot_data) waiting for the worker
+        self.result = None # (request id, (x, y_axs) or exception) of the latest finished request
+        self.closed = False
+        self.poll_id = None
+        self.loader = threading.Thread(target=self.load_loop, daemon=True)
+        self.loader.start()
+
         self.plotFrame = tk.Frame(self, width=500, height=500)
         self.settingsWidgets = SettingsWidgets(self, settings, 4, 2, 5)
         self.statsLabels = Statistics(self, self.labels, 4, 8, 20)
@@ -136,6 +190,7 @@ class StatisticsMenu(tk.Frame):
 
         self.applyButton = tk.Button(self.bottomFrame, text='Update', command=self.update)
         self.applyButton.grid(row=0, column=0, sticky='w')
+        self.loadingLabel = tk.Label(self.bottomFrame, text='Loading...', fg='red')
 
         # Add settings
         self.settingsWidgets.add_setting(tk.Checkbutton, "Grid", "Show grid")
@@ -159,23 +214,88 @@ class StatisticsMenu(tk.Frame):
         self.create_fig()
         self.update()
 
-    # Update all settings and the graph
+    # Update all settings and start loading the graph, the old one is shown until the new one is ready
     def update(self):
         self.settingsWidgets.apply_settings() 
+        with self.load_lock:
+            self.request_id += 1
+            self.pending = (self.request_id, self.data_params())
+            self.load_lock.notify()
+        self.loadingLabel.grid(row=0, column=1, padx=8)
+        if self.poll_id is None:
+            self.poll_id = self.after(LOADING_POLL_MS, self.poll_loading)
+
+    # Runs in the worker thread, loads requests until the tab is closed
+    def load_loop(self):
+        while True:
+            with self.load_lock:
+                while self.pending is None and not self.closed:
+                    self.load_lock.wait()
+                if self.closed:
+                    return
+                request_id, params = self.pending
+                self.pending = None
+            try:
+                data = self.plot_data(request_id, *params)
+            except Exception as e:
+                data = e # Raised again in the tkinter thread
+            with self.load_lock:
+                if data is not None and request_id == self.request_id:
+                    self.result = (request_id, data)
+
+    # Whether the user asked for another graph since the request was made
+    def superseded(self, request_id):
+        with self.load_lock:
+            return request_id != self.request_id or self.closed
+
+    # Draws the graph once the latest request is loaded, otherwise checks again later
+    def poll_loading(self):
+        with self.load_lock:
+            result = self.result if self.result is not None and self.result[0] == self.request_id else None
+        if result is None:
+            self.poll_id = self.after(LOADING_POLL_MS, self.poll_loading)
+            return
+
+        self.poll_id = None
+        self.loadingLabel.grid_remove()
+        _, data = result
+        if isinstance(data, Exception):
+            raise data
+        x, y_axs = data
         self.fig.clear()
-        self.plot()
+        self.plot(x, y_axs)
         self.statsLabels.update_stats(self.y_axs)
 
+    def destroy(self):
+        with self.load_lock:
+            self.closed = True
+            self.load_lock.notify()
+        if self.poll_id is not None:
+            self.after_cancel(self.poll_id)
+            self.poll_id = None
+        super().destroy()
+
 
-    # Get data as a dict of <Date>: <number of occurrences> pairs for both foxes and cats
+    # Get data as a dict of <label>: (<dates>, <numbers of occurrences>) arrays for both foxes and cats, sorted by date
     # Rounds date to nearest n seconds and averages across m second periods
-    def records_to_dict(self, records, round_sec, average_period, start=None, end=None):
+    # Buckets of rollups (see dbutils.Rollups) which lie completely between start and end are counted as a whole,
+    # only records in the buckets at the edges are read one by one
+    def records_to_dict(self, round_sec, average_period, start=None, end=None):
+        bucket_sec = dbutils.ROLLUP_SECONDS
+        # Records of a bucket are rounded to the same time, except the one at its very start, as long as
+        # round_sec / 2 is a multiple of the bucket length. This holds for all periods from hours up
+        assert round_sec % (2 * bucket_sec) == 0
+        rollups = self.db.read_rollups(self.labels)
+
         data = {}
         # Include everything if not stated otherwise
         if start == None:
+            first_buckets = [buckets[0] for buckets, _, _ in rollups.values() if len(buckets) > 0]
             start = INF
-            for row in records:
-                start = min(start, int(row['Unix time']))
+            if len(first_buckets) > 0:
+                first_bucket = min(first_buckets)
+                start = int(self.db.query(first_bucket * bucket_sec, (first_bucket + 1) * bucket_sec - 1,
+                                          self.labels).times.min())
         if end == None:
             end = time_lib.time()
         
@@ -185,20 +305,45 @@ class StatisticsMenu(tk.Frame):
         else:
             average_divisor = 1
 
+        # Collect times and numbers of records for every label, then round all of them at once
+        times = {label: [] for label in self.labels}
+        counts = {label: [] for label in self.labels}
+
+        # Whole buckets
+        first_full = math.ceil(start / bucket_sec)
+        last_full = math.floor((end + 1) / bucket_sec) - 1
+        for label, (buckets, bucket_counts, start_counts) in rollups.items():
+            full = (first_full <= buckets) & (buckets <= last_full)
+            bucket_starts = buckets[full] * bucket_sec
+            times[label] += [bucket_starts, bucket_starts + 1]
+            counts[label] += [start_counts[full], bucket_counts[full] - start_counts[full]]
+
+        # Records at the edges
+        if start == INF:
+            edges = []
+        elif first_full > last_full:
+            edges = [self.db.query(start, end, self.labels)]
+        else:
+            edges = [self.db.query(start, first_full * bucket_sec - 1, self.labels),
+                     self.db.query((last_full + 1) * bucket_sec, end, self.labels)]
+        for records in edges:
+            for label in self.labels:
+                if label in records.labels:
+                    label_times = records.times[records.codes == records.labels.index(label)]
+                    times[label].append(label_times)
+                    counts[label].append(np.ones(len(label_times), dtype=np.int64))
+
         for label in self.labels:
-            data[label] = {}
-
-        for row in records:
-            unix_time = int(row['Unix time'])
-            # Skip if out of needed time period
-            if unix_time < start or end < unix_time:
-                continue
-            dict = data[row['Label']]
-            time = round(unix_time / round_sec) * round_sec # Round the time
-            time %= average_period
-            if time not in dict:
-                dict[time] = 0
-            dict[time] += 1 / average_divisor
+            label_times = np.concatenate(times[label]) if times[label] else np.zeros(0, dtype=np.int64)
+            label_counts = np.concatenate(counts[label]) if counts[label] else np.zeros(0, dtype=np.int64)
+            label_times, label_counts = label_times[label_counts > 0], label_counts[label_counts > 0]
+
+            # Round the time, np.rint rounds halves to even like round()
+            rounded = np.rint(label_times / round_sec).astype(np.int64) * round_sec
+            if average_period != INF:
+                rounded %= average_period
+            dates, index = np.unique(rounded, return_inverse=True)
+            data[label] = (dates, np.bincount(index.reshape(-1), weights=label_counts, minlength=len(dates)) / average_divisor)
         
         return data
     
@@ -221,13 +366,31 @@ class StatisticsMenu(tk.Frame):
             unix = time_lib.mktime(date.timetuple())
             return unix
 
-    # Draw a plot using matplotlib
-    # Rounds time to n seconds
-    def plot(self):
+    # Converts sorted unix times to local dates, same as datetime.fromtimestamp for every time
+    def local_dates(self, times):
+        offset = lambda unix_time: time_lib.localtime(int(unix_time)).tm_gmtoff
+        offsets = np.empty(len(times), dtype=np.int64)
+
+        # The UTC offset changes a few times a year at most, so it is looked up at the ends of month long ranges,
+        # and ranges with different offsets at the ends are split in halves until the change is found
+        month = 3600 * 24 * 30
+        bounds = np.searchsorted(times, np.arange(times[0], times[-1] + 1, month)).tolist() + [len(times)]
+        ranges = [(lo, hi - 1) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+        while ranges:
+            lo, hi = ranges.pop()
+            offset_lo = offset(times[lo])
+            if offset_lo == offset(times[hi]):
+                offsets[lo : hi + 1] = offset_lo
+            else:
+                middle = (lo + hi) // 2
+                ranges += [(lo, middle), (middle + 1, hi)]
+        return (times + offsets).astype('datetime64[s]')
+
+    # Arguments of plot_data from settings: start, end, length of a period and period to average across
+    def data_params(self):
         start = self.str_time_to_unix(self.settings.get("Plot start"))
         end = self.str_time_to_unix(self.settings.get("Plot end"))
 
-        colors = ['r', 'b', 'g', 'y'] # Colors for plots
         periods = ["Hours", "Days", "Weeks", "Months", "Years"]
         periods_to_seconds = {"Hours" : 3600,
                               "Days"  : 3600 * 24,
@@ -242,39 +405,41 @@ class StatisticsMenu(tk.Frame):
             average_period = periods_to_seconds[average_period_str]
         else:
             average_period = INF
+        return start, end, round_sec, average_period
 
+    # Returns x axis and y axes of the plot, rounds time to n seconds
+    # Runs in the worker thread, returns None if the request was superseded before the data was loaded
+    def plot_data(self, request_id, start, end, round_sec, average_period):
         # Get data
-        records = self.db.read_records()
-        records_dict = self.records_to_dict(records, round_sec, average_period, start, end)
+        records_dict = self.records_to_dict(round_sec, average_period, start, end)
+        if self.superseded(request_id):
+            return None
 
         # Determine boundaries of the plot
-        min_time = INF
-        max_time = -1
-        for label_dict in records_dict.values():
-            if len(label_dict) == 0:
+        for label, (dates, values) in records_dict.items():
+            if len(dates) == 0:
                 dummy_time = round(time_lib.time() / round_sec) * round_sec # Round the time
                 dummy_time %= average_period
-                label_dict[dummy_time] = 0
-            min_time = min(min_time, min(label_dict))
-            max_time = max(max_time, max(label_dict))
-
-
-        x = [] # Single x axis
-        y_axs = {} # Multiple y axes for each label
-        for label in records_dict:
-            y_axs[label] = []
-
-        # Fill x and y axes
-        for time in range(min_time, max_time + 1, round_sec):
-            x.append(datetime.datetime.fromtimestamp(time))
-            for label in records_dict:
-                if time not in records_dict[label]:
-                    y_axs[label].append(0) # Add 0 if no animals were detected at that time
-                else:
-                    y_axs[label].append(records_dict[label][time]) # Add number of animals detected at that time
-        
+                records_dict[label] = (np.array([dummy_time], dtype=np.int64), np.zeros(1))
+        min_time = min(int(dates[0]) for dates, _ in records_dict.values())
+        max_time = max(int(dates[-1]) for dates, _ in records_dict.values())
+
+        # Fill x and y axes, with 0 where no animals were detected. Single x axis, y axis for each label
+        # Only times which are a whole number of periods after min_time are on the axis
+        n_steps = (max_time - min_time) // round_sec + 1
+        x = self.local_dates(min_time + np.arange(n_steps, dtype=np.int64) * round_sec)
+        y_axs = {}
+        for label, (dates, values) in records_dict.items():
+            steps, remainders = np.divmod(dates - min_time, round_sec)
+            on_axis = remainders == 0
+            y_axs[label] = np.bincount(steps[on_axis], weights=values[on_axis], minlength=n_steps)
+        return x, y_axs
+
+    # Draw a plot using matplotlib
+    def plot(self, x, y_axs):
+        colors = ['r', 'b', 'g', 'y'] # Colors for plots
         self.plots = {}
-        for i, label in enumerate(records_dict):
+        for i, label in enumerate(y_axs):
             show = self.settings.get("Show " + label)
             if show:
                 self.plots[label], = plt.plot(x, y_axs[label], color=colors[i], label=label)
@@ -289,7 +454,6 @@ class StatisticsMenu(tk.Frame):
         plt.legend()
         self.fig_canvas.draw()
         self.toolbar.update()
-        print(records_dict)
 
 
 class SettingsMenu(tk.Frame):
@@ -322,10 +486,19 @@ class SettingsMenu(tk.Frame):
                                                                                       "1920x1080"],
                                 validation_regex=r'\d+x\d+')
         settingsFrame.add_setting(tk.Checkbutton, 'Autostart camera')
+        settingsFrame.add_setting(ttk.Combobox, 'Database backend', width=7, values=list(dbutils.BACKENDS), state='readonly')
+        settingsFrame.add_setting(tk.Entry, 'Exported model', 'Exported model (empty for NN.pkl)', width=20)
+        settingsFrame.add_setting(tk.Entry, 'Stats file', 'Stats file (empty to turn off)', width=20)
+        settingsFrame.add_setting(tk.Entry, 'Stats port', 'Stats HTTP port (empty to turn off)', width=6,
+                                  validation_regex=r'\d*')
         settingsFrame.add_setting(tk.Entry, 'Camera start time', 'Camera start time (hh:mm)', width=5,
                                   validation_regex=r'\d{2}:\d{2}')
         settingsFrame.add_setting(tk.Entry, 'Camera end time', 'Camera end time (hh:mm)', width=5,
                                   validation_regex=r'\d{2}:\d{2}')
+        settingsFrame.add_setting(tk.Entry, 'Camera schedule', 'Camera schedule (e.g. Mon-Fri 23:00-6:00)', width=30,
+                                  validation_regex=schedutils.PATTERN)
+        settingsFrame.add_setting(tk.Entry, 'Camera crop', 'Camera crop (top,bottom,left,right)', width=15,
+                                  validation_regex=r'\d+,\d+,\d+,\d+')
 
 
 # Frame with settings and convenient functions for creating them
@@ -450,6 +623,7 @@ class Statistics(tk.Frame):
 class VideoPlayer(tk.Frame):
     def __init__(self, master, settings: settings.Settings, db: dbutils.Database, *args, **kwargs):
         super().__init__(master, *args, **kwargs)
+        from tkVideoPlayer import TkinterVideo # Imported here because it is slow to import and rarely needed
         self.settings = settings
         self.db = db
 
@@ -457,7 +631,8 @@ class VideoPlayer(tk.Frame):
         self.VIDEO_WIDTH = 768
 
         self.video_index = 0
-        self.videos_list = ["videos/" + file for file in os.listdir('./videos')]
+        self.videos_list = ["videos/" + file for file in os.listdir('./videos')
+                            if not file.startswith(dbutils.RECORDING_PREFIX)] # Skip videos which are still being recorded
         self.videos_list.sort()
 
         self.videoLabel = tk.Label(self)
@@ -595,7 +770,7 @@ class VideoPlayer(tk.Frame):
     
 # Progress bar below the video to navigate it using mouse
 class ProgressBar(tk.Frame):
-    def __init__(self, master, height, width, video: TkinterVideo, *args, **kwargs):
+    def __init__(self, master, height, width, video: 'TkinterVideo', *args, **kwargs):
         super().__init__(master, height=height, width=width, *args, **kwargs)
         self.user_paused = False
         self.click_in_progress = False
@@ -669,6 +844,15 @@ class Placeholder(tk.Frame):
 def main():
     window = MainApp()
     window.protocol('WM_DELETE_WINDOW', window.close)
+
+    # Run with --timing to see where the startup time goes
+    if '--timing' in sys.argv:
+        def report():
+            print(f"Imports finished after {IMPORTS_TIME - STARTUP_TIME:.3f}s")
+            print(f"Window ready after {time_lib.perf_counter() - STARTUP_TIME:.3f}s")
+            startutils.print_import_report('main')
+        window.after_idle(report)
+
     window.mainloop()
 
 if __name__ == '__main__':
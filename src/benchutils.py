@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import argparse
+import datetime
+import subprocess
+import tempfile
+import threading
+import cv2 as cv
+import numpy as np
+from src import dbutils, metricutils, queueutils
+
+# Generates frames instead of a camera: a noisy static scene with an object crossing it from time to time
+# Has the same grab/retrieve/release interface as cv.VideoCapture
+class SyntheticCapture():
+    def __init__(self, n_frames=1000, shape=(1080, 1920, 3), event_every=300, event_length=60, seed=0):
+        self.n_frames = n_frames
+        self.shape = shape
+        self.event_every = event_every # A moving object appears every n frames
+        self.event_length = event_length # and stays for this many frames
+        self.index = -1
+
+        # A few noise frames are generated up front and reused, generating noise for every frame is too slow
+        rng = np.random.default_rng(seed)
+        self.background = rng.integers(40, 90, shape, dtype=np.uint8)
+        self.noise = [np.clip(self.background + rng.normal(0, 2, shape), 0, 255).astype(np.uint8) for _ in range(8)]
+
+    def isOpened(self):
+        return self.index < self.n_frames
+
+    def grab(self):
+        self.index += 1
+        return self.index < self.n_frames
+
+    def retrieve(self, image=None):
+        if image is None or image.shape != self.shape:
+            image = np.empty(self.shape, dtype=np.uint8)
+        np.copyto(image, self.noise[self.index % len(self.noise)])
+
+        # Draw an object moving from left to right
+        event_frame = self.index % self.event_every
+        if event_frame < self.event_length:
+            height, width = self.shape[:2]
+            size = height // 5
+            x = int((width - size) * event_frame / self.event_length)
+            y = height // 2
+            image[y : y + size, x : x + size] = 220
+        return True, image
+
+    def release(self):
+        pass
+
+
+# Peak resident memory of the process in MiB, None if it can't be measured on this system
+def peak_memory():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # Linux reports kilobytes
+
+# Returns the current git commit, so results of different commits can be compared
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+# Runs the whole camera pipeline on one source and returns measurements
+# source is a path to a video file or 'synthetic'. With recorded_speed frames arrive at the video's fps,
+# otherwise as fast as the pipeline can take them (no frames or clips are dropped)
+def benchmark_source(source, classifier, recorded_speed=False, n_synthetic_frames=1000, log=False):
+    from src import camutils
+
+    if source == 'synthetic':
+        open_capture = lambda url: SyntheticCapture(n_synthetic_frames)
+        fps = 14
+    else:
+        open_capture = cv.VideoCapture
+        video = cv.VideoCapture(source)
+        fps = video.get(cv.CAP_PROP_FPS) or 14
+        video.release()
+
+    source_options = {'open_capture': open_capture,
+                      'fps': fps if recorded_speed else None,
+                      'lossless': not recorded_speed,
+                      'reconnect': False}
+    always = datetime.datetime.strptime("00:00", "%H:%M") # Equal start and end times mean working all day
+    db = dbutils.Database(log=log)
+    # As fast as possible the grabber waits for the pipeline, the queue must wait for the workers too
+    queue_options = {} if recorded_speed else {'queue_policy': queueutils.BLOCK, 'queue_memory': None}
+    camera = camutils.Camera(source, db, always, always, log=log, classifier=classifier,
+                             source_options=source_options, **queue_options)
+
+    # Stages are measured by the pipeline itself, see metricutils
+    metricutils.metrics.reset()
+    start = time.perf_counter()
+    camera.start(threading.Event())
+    elapsed = time.perf_counter() - start
+    db.close()
+
+    capture = camera.capture_stats()
+    snapshot = metricutils.metrics.snapshot()
+    histogram = lambda name: snapshot['histograms'].get(name, {'count': 0}) # Seconds
+    queue = camera.queue_stats()
+    return {'frames': capture['frames analysed'],
+            'clips dropped': queue['dropped'], # Clips the workers didn't keep up with, not classified
+            'seconds': elapsed,
+            'frames per second': capture['frames analysed'] / elapsed if elapsed else 0,
+            'capture': capture,
+            'queue': queue,
+            'motion check': histogram('motion check'),
+            'classification per clip': histogram('classify clip'),
+            'classification per frame': histogram('classify frame'),
+            'encode per frame': histogram('video encode'),
+            'video save': histogram('video save'),
+            'labels': {name: value for name, value in snapshot['counters'].items() if name.startswith('label ')},
+            'peak memory MiB': peak_memory()}
+
+
+# Benchmarks all sources and writes the results to a json file
+def run_benchmark(sources, output='bench_output.json', recorded_speed=False, model_path=None,
+                  n_synthetic_frames=1000, log=False):
+    from src import camutils
+    classifier = camutils.Classifier(model_path=model_path)
+    classifier.load() # Don't count loading the model
+
+    # Saved videos and records go to a temporary folder, not the real database
+    with tempfile.TemporaryDirectory() as folder:
+        dbutils.DATABASE_PATH = os.path.join(folder, 'database.csv')
+        dbutils.VIDEOS_PATH = folder + '/videos/'
+        dbutils.Database().delete_database()
+
+        results = {'commit': git_commit(),
+                   'date': time.strftime("%d/%m/%y %H:%M:%S"),
+                   'recorded speed': recorded_speed,
+                   'model': model_path or camutils.LEARNER_PATH,
+                   'sources': {}}
+        for source in sources:
+            print(f"Benchmarking {source}")
+            results['sources'][source] = benchmark_source(source, classifier, recorded_speed, n_synthetic_frames, log)
+            print(json.dumps(results['sources'][source], indent=4))
+            if results['sources'][source]['clips dropped'] > 0:
+                print(f"WARNING: {results['sources'][source]['clips dropped']} clips of {source} were dropped, "
+                      f"the classification times don't cover them")
+
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=4)
+    return results
+
+
+# Run from the project folder: python -m src.benchutils videos/cool_fox.mp4 synthetic
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay videos through the camera pipeline and measure it')
+    parser.add_argument('sources', nargs='*', help="Video files or 'synthetic'. Defaults to all videos in ./videos/")
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--recorded-speed', action='store_true', help='Replay at the fps of the video instead of as fast as possible')
+    parser.add_argument('--model', default=None, help='Exported model to use instead of NN.pkl')
+    parser.add_argument('--synthetic-frames', type=int, default=1000)
+    parser.add_argument('--log', action='store_true')
+    args = parser.parse_args()
+
+    sources = args.sources or ['./videos/' + file for file in sorted(os.listdir('./videos')) if file.endswith('.mp4')]
+    run_benchmark(sources, args.output, args.recorded_speed, args.model, args.synthetic_frames, args.log)
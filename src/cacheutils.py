@@ -0,0 +1,76 @@
+import collections
+import hashlib
+import threading
+import cv2 as cv
+import numpy as np
+from src import metricutils
+
+# 64-bit difference hash of an image: the image is shrunk to 9x8 grayscale pixels
+# and every bit tells whether a pixel is brighter than its right neighbour
+# Frames which differ only by sensor noise get the same or very close hashes
+def perceptual_hash(image):
+    gray = cv.cvtColor(image, cv.COLOR_RGB2GRAY) if image.ndim == 3 else image
+    small = cv.resize(gray, (9, 8), interpolation=cv.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+# Number of different bits between two hashes
+def hash_distance(hash1, hash2):
+    return bin(hash1 ^ hash2).count('1')
+
+# Digest of the exact pixels and shape of an image, equal only for identical images
+def content_hash(image):
+    return (image.shape, hashlib.blake2b(np.ascontiguousarray(image).data, digest_size=16).digest())
+
+
+# LRU cache of class probabilities keyed by hashes of images
+# With max_distance=0 keys are content hashes and only identical images hit
+# With max_distance > 0 keys are perceptual hashes and an image is a hit if a cached hash is within max_distance bits
+# of its hash. This is lossy: an animal which covers a small part of the image can keep the hash of the empty scene
+class PredictionCache():
+    def __init__(self, capacity=256, max_distance=0):
+        self.capacity = capacity
+        self.max_distance = max_distance
+        self.entries = collections.OrderedDict() # hash: probabilities, least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Key of an image for get and put
+    def key(self, image):
+        return perceptual_hash(image) if self.max_distance > 0 else content_hash(image)
+
+    # Returns cached probabilities for a hash or None
+    def get(self, image_hash):
+        with self.lock:
+            key = image_hash if image_hash in self.entries else None
+            if key is None and self.max_distance > 0:
+                # Capacity is small, so a linear scan is cheap compared to running the network
+                for cached_hash in self.entries:
+                    if hash_distance(cached_hash, image_hash) <= self.max_distance:
+                        key = cached_hash
+                        break
+
+            if key is None:
+                self.misses += 1
+                metricutils.metrics.count('prediction cache misses')
+                return None
+            self.hits += 1
+            metricutils.metrics.count('prediction cache hits')
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, image_hash, probs):
+        with self.lock:
+            self.entries[image_hash] = probs
+            self.entries.move_to_end(image_hash)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit rate': self.hits / total if total else 0,
+                    'size': len(self.entries)}
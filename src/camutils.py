@@ -1,210 +1,737 @@
 import os
-if os.name == 'nt': # Fix for windows and fastai library
-    import pathlib
-    pathlib.PosixPath = pathlib.WindowsPath
-
-from fastai.vision.all import *
 import cv2 as cv
 import threading
+import queue
+import concurrent.futures
 import numpy as np
-from src import dbutils
+from src import dbutils, queueutils, motionutils, frameutils, metricutils, cacheutils, schedutils
 import datetime
 import time
 
 LEARNER_PATH = './NN.pkl'
+DEFAULT_CROP = (100, 10, 0, 50) # Number of pixels to crop (top, bottom, left, right)
 
 # A classifier based on CNN that identifies object on a video/image
 # Possible options: Empty; Human; Cat; Dog; Fox
+# If model_path is given, an exported model (see nnutils) is used instead of the fastai learner
+# torch/fastai and the model are loaded only when they are needed for the first time (or by warm_up)
 class Classifier():
-    def __init__(self):
+    def __init__(self, batch_size=16, model_path=None, sampling='keyframes', early_exit=True, min_frames=12,
+                 confidence_z=2.58, cache_size=0, cache_distance=0):
         self.LEARNER_PATH = LEARNER_PATH
-        self.learner = load_learner(self.LEARNER_PATH)
+        self.model_path = model_path
+        self.learner = None
+        self.exported = None
+        self.vocab = None
+        self.loaded = False
+        self.load_lock = threading.Lock()
         self.MSE_THRESHOLD = 20
+        self.batch_size = batch_size # Number of frames passed through the learner at once
+
+        # Frame sampling and early exit, see ClipClassification
+        self.sampling = sampling
+        self.early_exit = early_exit
+        self.min_frames = min_frames
+        self.confidence_z = confidence_z
 
-        # Number of pixels to crop each side
-        self.top_crop = 100
-        self.bottom_crop = 10
-        self.left_crop = 0
-        self.right_crop = 50
+        # Repeated frames reuse cached predictions, see cacheutils. Off by default (cache_size=0)
+        # With cache_distance=0 only identical images hit, so sharing the cache between clips and cameras is safe
+        self.cache = cacheutils.PredictionCache(cache_size, cache_distance) if cache_size > 0 else None
+        self.lock = threading.Lock() # The learner can't run in several threads at once
+
+    # Import torch/fastai and load the model if it isn't loaded yet
+    def load(self):
+        with self.load_lock:
+            if self.loaded:
+                return
+            if self.model_path:
+                from src import nnutils
+                self.exported = nnutils.ExportedModel(self.model_path)
+                self.vocab = self.exported.vocab
+            else:
+                if os.name == 'nt': # Fix for windows and fastai library
+                    import pathlib
+                    pathlib.PosixPath = pathlib.WindowsPath
+                from fastai.learner import load_learner
+                import fastai.vision.all # Registers the transforms the pickled learner refers to
+                self.learner = load_learner(self.LEARNER_PATH)
+                self.vocab = self.learner.dls.vocab
+            self.loaded = True
+
+    # Load the model in a background thread so the first classification doesn't wait for it
+    def warm_up(self):
+        thread = threading.Thread(target=self.load, daemon=True, name='classifier-warm-up')
+        thread.start()
+        return thread
 
     # Crops frame by n pixels in each direction
     def crop_frame(self, frame, top_crop, bottom_crop, left_crop, right_crop):
         return frame[top_crop : frame.shape[0] - bottom_crop, 
                      left_crop : frame.shape[1] - right_crop]
     
-    # Calculates MSE between two frames
-    def mse(self, frame1, frame2):
-        # Cast uint8 to int32 to avoid overflow
-        frame1 = frame1.astype(np.int32)
-        frame2 = frame2.astype(np.int32)
-    
-        assert frame1.shape == frame2.shape, "Shapes do not match"
+    # Finds frames that differ from the previous one and the region of the clip where the movement is
+    # crop is (top, bottom, left, right) number of pixels cut from the frame first. Then, if the movement
+    # in the clip is concentrated in one place, frames are later cut to a padded square around it (region)
+    # Returns (moving frames, their MSE, region or None)
+    def find_moving_frames(self, video, crop=DEFAULT_CROP):
+        moving_frames = []
+        scores = []
+        motion_box = None # Box containing movement of the whole clip
+        motion = motionutils.MotionDetector() # Local detector, so several threads can select frames at once
+        for frame in video:
+            frame = self.crop_frame(frame, *crop)
+            mse = motion.update(frame)
+            if mse > self.MSE_THRESHOLD:
+                moving_frames.append(frame)
+                scores.append(mse)
+                motion_box = motionutils.merge_boxes(motion_box, motion.bounding_box())
 
-        # Calculate MSE
-        mse = np.mean((frame1 - frame2) ** 2)
-        return mse
-    
-    # Classifies a video. Video must be a list of frames
-    def classify_video(self, video):
+        # Fall back to the whole frame if there is no clear moving region
+        region = motionutils.pad_box(motion_box, moving_frames[0].shape) if moving_frames else None
+        return moving_frames, scores, region
+
+    # Cuts the region out of a frame and converts it to RGB for the learner
+    def prepare_image(self, frame, region):
+        if region is not None:
+            x, y, width, height = region
+            frame = frame[y : y + height, x : x + width]
+        return cv.cvtColor(frame, cv.COLOR_BGR2RGB) # Convert from BGR to RGB
+
+    # Converts and crops every frame that differs from the previous one
+    def select_frames(self, video, crop=DEFAULT_CROP):
+        moving_frames, _, region = self.find_moving_frames(video, crop)
+        return [self.prepare_image(frame, region) for frame in moving_frames]
+
+    # Runs images through the learner in batches
+    # Returns a (number of images, number of labels) array of class probabilities
+    def predict_probs(self, images):
+        self.load()
+        if len(images) == 0:
+            return np.zeros((0, len(self.vocab)), dtype=np.float32)
+        if self.cache is None:
+            return self.run_model(images)
+
+        # Run the network only on images which aren't in the cache
+        hashes = [self.cache.key(image) for image in images]
+        probs = [self.cache.get(image_hash) for image_hash in hashes]
+        missing = [i for i, p in enumerate(probs) if p is None]
+        if len(missing) > 0:
+            new_probs = self.run_model([images[i] for i in missing])
+            for i, p in zip(missing, new_probs):
+                probs[i] = p
+                self.cache.put(hashes[i], p)
+        return np.stack(probs)
+
+    # Returns counters of the prediction cache
+    def cache_stats(self):
+        return self.cache.stats() if self.cache is not None else None
+
+    # Runs images through the network without the cache
+    def run_model(self, images):
+        with self.lock:
+            start = time.perf_counter()
+            if self.exported is not None:
+                probs = self.exported.predict_probs(images, self.batch_size)
+            else:
+                dl = self.learner.dls.test_dl(images, bs=self.batch_size, num_workers=0)
+                with self.learner.no_bar(), self.learner.no_logging():
+                    probs = self.learner.get_preds(dl=dl)[0].numpy()
+        metricutils.metrics.observe('classify frame', (time.perf_counter() - start) / len(images))
+        metricutils.metrics.count('frames classified', len(images))
+        return probs
+
+    # Picks a label for the video using predicted probabilities of its frames
+    # If probs are only a sample of n_frames moving frames, the number of empty frames is scaled up
+    def vote(self, probs, video_length, n_frames=None):
+        self.load()
         predictions = {'Empty': 0,
                        'Human': 0,
                        'Cat'  : 0,
                        'Dog'  : 0,
                        'Fox'  : 0}
 
-        # Get predictions for each frame
-        for i, frame in enumerate(video):
-            if self.mse(video[i - 1], frame) > self.MSE_THRESHOLD:
-                transformed_frame = cv.cvtColor(frame, cv.COLOR_BGR2RGB) # Convert from BGR to RGB
-                transformed_frame = self.crop_frame(transformed_frame, self.top_crop, self.bottom_crop, self.left_crop, self.right_crop) # Crop the frame
-                predictions[self.classify_img(transformed_frame)] += 1
+        # Count the most probable label of each frame
+        for index in np.argmax(probs, axis=1):
+            predictions[self.vocab[index]] += 1
 
-        # Return 'Empty' if >90% of frames are classified as empty
+        # Return 'Empty' if >95% of frames are classified as empty
         empty_count = predictions['Empty']
+        if n_frames is not None and len(probs) > 0:
+            empty_count *= n_frames / len(probs)
         predictions['Empty'] = 0
-        if (empty_count / len(video) > 0.95):
+        if (empty_count / video_length > 0.95):
             return 'Empty'
         
         # Else return most popular prediction
         else:
             return max(predictions, key=predictions.get) # Get the key with maximum value
 
+    # Prepares a clip for classification in steps, see ClipClassification
+    def start_clip(self, video, crop=DEFAULT_CROP):
+        moving_frames, scores, region = self.find_moving_frames(video, crop)
+        return ClipClassification(self, moving_frames, scores, region, len(video),
+                                  self.sampling, self.early_exit, self.min_frames, self.confidence_z)
+
+    # Classifies a video step by step until the label is settled
+    # Returns a dictionary with the label, mean class probabilities and numbers of frames
+    def classify_clip(self, video, crop=DEFAULT_CROP):
+        clip = self.start_clip(video, crop)
+        while not clip.done():
+            clip.add_probs(self.predict_probs(clip.next_images(self.batch_size)))
+        return clip.result()
+    
+    # Classifies a video. Video must be a list of frames
+    def classify_video(self, video, crop=DEFAULT_CROP):
+        return self.classify_clip(video, crop)['label']
+
     # Classifies a single image
     def classify_img(self, img):
+        self.load()
+        if self.exported is not None:
+            return self.vocab[np.argmax(self.predict_probs([img])[0])]
         label = self.learner.predict(img)[0]
         return label
 
 
+# Classification of one clip, done a few frames at a time
+# Frames are taken in the order given by the sampling strategy:
+#   'keyframes' - frames with the highest MSE first, 'stride' - every n-th frame first, then the ones between,
+#   'all' - in order, without stopping early
+# With early_exit, classification stops once the leading label is statistically settled: the mean difference
+# between the probabilities of the leading label and the runner-up is above zero with a margin of
+# confidence_z standard errors. Otherwise all moving frames are classified, which gives the same label as before
+class ClipClassification():
+    def __init__(self, classifier: Classifier, frames, scores, region, video_length,
+                 sampling='keyframes', early_exit=True, min_frames=12, confidence_z=2.58):
+        self.classifier = classifier
+        self.frames = frames
+        self.region = region
+        self.video_length = video_length
+        self.early_exit = early_exit and sampling != 'all'
+        self.min_frames = min_frames # Never stop before this many frames are classified
+        self.confidence_z = confidence_z
+        self.probs = []
+        self.position = 0 # Number of frames already taken from self.order
+
+        if sampling == 'keyframes':
+            self.order = list(np.argsort(scores)[::-1])
+        elif sampling == 'stride':
+            stride = 8
+            self.order = [i for offset in range(stride) for i in range(offset, len(frames), stride)]
+        else:
+            self.order = list(range(len(frames)))
+
+    # Number of frames which haven't been classified yet
+    def remaining(self):
+        return len(self.order) - self.position
+
+    # Returns up to n next images to classify
+    def next_images(self, n):
+        indices = self.order[self.position : self.position + n]
+        self.position += len(indices)
+        return [self.classifier.prepare_image(self.frames[i], self.region) for i in indices]
+
+    # Adds probabilities of the images returned by next_images
+    def add_probs(self, probs):
+        self.probs.append(probs)
+
+    def all_probs(self):
+        if len(self.probs) == 0:
+            return np.zeros((0, len(self.classifier.vocab)), dtype=np.float32)
+        return np.concatenate(self.probs)
+
+    def label(self):
+        return self.classifier.vote(self.all_probs(), self.video_length, len(self.frames))
+
+    # Checks if classifying more frames is unlikely to change the label
+    def settled(self):
+        probs = self.all_probs()
+        if len(probs) < self.min_frames:
+            return False
+
+        # Compare the leading label with the most probable other label
+        leader = list(self.classifier.vocab).index(self.label())
+        mean_probs = probs.mean(axis=0)
+        mean_probs[leader] = -1
+        runner_up = int(np.argmax(mean_probs))
+        differences = probs[:, leader] - probs[:, runner_up]
+        standard_error = differences.std(ddof=1) / np.sqrt(len(differences))
+        return differences.mean() - self.confidence_z * standard_error > 0
+
+    def done(self):
+        return self.remaining() == 0 or (self.early_exit and self.settled())
+
+    def result(self):
+        probs = self.all_probs()
+        mean_probs = probs.mean(axis=0) if len(probs) > 0 else np.zeros(len(self.classifier.vocab))
+        return {'label': self.label(),
+                'probabilities': {label: round(float(p), 4) for label, p in zip(self.classifier.vocab, mean_probs)},
+                'frames classified': len(probs),
+                'frames moving': len(self.frames),
+                'early exit': self.remaining() > 0}
+
+
+# Runs one Classifier for many cameras
+# Clips are submitted from any thread and answered through futures. The next frames of all clips being classified
+# are merged into shared batches, so several cameras cost one model in memory and fewer, fuller forward passes
+class ClassifierService():
+    def __init__(self, classifier=None, max_batch=64, log=False):
+        self.classifier = classifier if classifier is not None else Classifier()
+        self.max_batch = max_batch # Maximum number of frames in a merged batch
+        self.log = log
+        self.requests = queue.Queue() # (ClipClassification, future) tuples or None to stop
+        self.stopped = False # Set by stop or when the service thread exits, no clips are accepted afterwards
+        self.stop_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve, daemon=True, name='classifier-service')
+        self.thread.start()
+
+    def print_log(self, message):
+        if self.log:
+            print(message)
+
+    def warm_up(self):
+        return self.classifier.warm_up()
+
+    # Submit a video for classification. Returns a future with the result of Classifier.classify_clip
+    # Raises RuntimeError if the service is stopped
+    def submit(self, video, crop=DEFAULT_CROP):
+        future = concurrent.futures.Future()
+        # Frames are selected in the caller's thread, the service thread only runs the model
+        clip = self.classifier.start_clip(video, crop)
+        with self.stop_lock:
+            if self.stopped:
+                raise RuntimeError("Classifier service is stopped")
+            self.requests.put((clip, future))
+        return future
+
+    # Same interface as Classifier.classify_clip and Classifier.classify_video
+    def classify_clip(self, video, crop=DEFAULT_CROP):
+        return self.submit(video, crop).result()
+
+    def classify_video(self, video, crop=DEFAULT_CROP):
+        return self.classify_clip(video, crop)['label']
+
+    # Main loop of the service thread
+    # A clip which fails is answered with its exception, the other clips go on
+    def serve(self):
+        active = [] # Clips which are being classified
+        try:
+            self.serve_clips(active)
+        except Exception as e:
+            for _, future in active:
+                future.set_exception(e)
+            raise
+        finally:
+            # Clips submitted after the thread stopped would never be answered
+            with self.stop_lock:
+                self.stopped = True
+            while True:
+                try:
+                    request = self.requests.get(block=False)
+                except queue.Empty:
+                    break
+                if request is not None:
+                    request[1].set_exception(RuntimeError("Classifier service is stopped"))
+
+    # Classifies clips until stopped. Clips being classified are kept in active, so serve can answer them
+    def serve_clips(self, active):
+        stopping = False
+        while not (stopping and len(active) == 0):
+            # Wait for a clip if there is nothing to do, then take all other waiting clips
+            while not stopping:
+                try:
+                    request = self.requests.get(block=len(active) == 0)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                else:
+                    active.append(request)
+            if len(active) == 0:
+                continue
+
+            # Take the next few frames of every clip
+            step = max(1, min(self.classifier.batch_size, self.max_batch // len(active)))
+            chunks = []
+            for clip, future in list(active):
+                try:
+                    chunks.append(clip.next_images(step))
+                except Exception as e:
+                    future.set_exception(e)
+                    active.remove((clip, future))
+            if len(active) == 0:
+                continue
+            images = [image for chunk in chunks for image in chunk]
+            self.print_log(f"Classifying {len(active)} clips with {len(images)} frames in one batch")
+            try:
+                probs = self.classifier.predict_probs(images)
+            except Exception as e:
+                for _, future in active:
+                    future.set_exception(e)
+                active.clear()
+                continue
+
+            # Split predictions back into clips and answer the clips which are done
+            start = 0
+            still_active = []
+            for (clip, future), chunk in zip(active, chunks):
+                clip_probs = probs[start : start + len(chunk)]
+                start += len(chunk)
+                try:
+                    clip.add_probs(clip_probs)
+                    if clip.done():
+                        future.set_result(clip.result())
+                    else:
+                        still_active.append((clip, future))
+                except Exception as e:
+                    future.set_exception(e)
+            active[:] = still_active
+
+    # Stop the service thread after it answers clips which are already submitted
+    def stop(self):
+        with self.stop_lock:
+            if not self.stopped:
+                self.stopped = True
+                self.requests.put(None)
+        self.thread.join()
+
+
 class Camera():
-    def __init__(self, rtsp_url, database, start_time: datetime.datetime, end_time: datetime.datetime, log=False):
+    def __init__(self, rtsp_url, database, start_time: datetime.datetime, end_time: datetime.datetime, log=False,
+                 queue_size=4, queue_policy=queueutils.DROP_OLDEST, n_workers=1, model_path=None, classifier=None,
+                 skip_frames=0, source_options=None, crop=DEFAULT_CROP, adaptive_threshold=True,
+                 schedule=None, queue_memory=2**30):
         self.rtsp_url = rtsp_url
-        self.classifier = Classifier()
+        # Several cameras can share a ClassifierService instead of loading a model each
+        self.classifier = classifier if classifier is not None else Classifier(model_path=model_path)
         self.db = database
         self.log = log
         self.start_time = start_time
         self.end_time = end_time
+        # Working hours, by default a single window between start_time and end_time every day
+        self.schedule = schedule if schedule is not None else schedutils.Schedule.from_times(start_time, end_time)
+        self.warm_up_lead = 60 # Seconds before a window opens to connect to the camera and load the model
+        self.crop = crop # Pixels cut from each side of frames before classification (top, bottom, left, right)
 
         # Fps in saved videos
         self.fps = 14
 
+        # Recorded clips wait in a queue and are classified and saved by worker threads,
+        # so reading the camera never stops because of the neural net or video encoding
+        # A clip is a copy of up to pre_roll + post_roll frames, so the queue is limited in bytes as well as in clips.
+        # Frames of a camera take at most: the ring buffer, max(queue_memory, one clip) of waiting clips,
+        # one clip per worker and frames waiting for the video encoder (see dbutils.VideoRecording).
+        # With the defaults and one worker that is 3 clips, 2.5 GiB at 2304x1296 or 1.7 GiB at 1920x1080
+        self.queue_size = queue_size
+        self.queue_memory = queue_memory # Bytes
+        self.queue_policy = queue_policy
+        self.n_workers = n_workers
+        self.clip_queue = None
+
+        self.motion = motionutils.MotionDetector() # Compares every new frame with the previous one
+        # Learns the usual MSE of the scene and raises the threshold when the picture is noisy
+        self.noise = motionutils.NoiseEstimator() if adaptive_threshold else None
+
+        # Number of frames recorded before and after movement is detected
+        self.pre_roll = 30
+        self.post_roll = 70
+        # Recent frames are kept in one preallocated array, clips are copied out of it
+        self.ring = frameutils.FrameRing(self.pre_roll + self.post_roll)
+
+        # Frames are grabbed in a separate thread, the analysis loop takes the newest one
+        self.grabber = None
+        self.source_options = source_options or {} # Extra FrameGrabber arguments, e.g. for replaying files
+        self.skip_frames = skip_frames # Analyse only every (skip_frames + 1)-th grabbed frame
+        self.last_seq = 0 # Sequence number of the last analysed frame
+        self.frames_read = 0
+        self.frames_dropped = 0 # Grabbed frames the analysis loop never saw
+        self.reconnects = 0 # Reconnects of grabbers which are already stopped
+        self.latency_total = 0 # Sum of seconds between grabbing and analysing frames
+        self.report_every = 1000 # Log capture stats every n frames
+
     # Prints message only of logging is turned on
     def print_log(self, message):
         if self.log:
             print(message)
 
-    # Calculates MSE between two frames
-    def mse(self, frame1, frame2):
-        # Cast uint8 to int32 to avoid overflow
-        frame1 = frame1.astype(np.int32)
-        frame2 = frame2.astype(np.int32)
-    
-        assert frame1.shape == frame2.shape, "Shapes do not match"
-
-        # Calculate MSE
-        mse = np.mean((frame1 - frame2) ** 2)
-        return mse
-    
-    # Read 1 frame from a camera
+    # Copy the newest grabbed frame into the ring buffer
     def read_frame(self):
-        try:
-            success, frame = self.cam.read()
-            return success, frame
-        except:
+        slot = self.ring.next_slot()
+        with metricutils.metrics.timer('frame read'):
+            success, frame, seq, timestamp = self.grabber.read(slot, self.last_seq + self.skip_frames)
+        if not success:
             return False, None
+
+        if frame is slot:
+            self.ring.commit()
+        else:
+            # The buffer isn't allocated yet or the resolution changed
+            self.ring.push(frame)
+            self.print_log(f"Allocated {self.ring.nbytes() // 2**20} MiB for {self.ring.capacity} frames")
+
+        # Frames skipped on purpose are not counted as dropped
+        if self.last_seq > 0:
+            dropped = max(0, seq - self.last_seq - 1 - self.skip_frames)
+            self.frames_dropped += dropped
+            metricutils.metrics.count('frames dropped', dropped)
+        self.last_seq = seq
+        self.frames_read += 1
+        latency = time.time() - timestamp
+        self.latency_total += latency
+        metricutils.metrics.count('frames analysed')
+        metricutils.metrics.observe('frame latency', latency)
+        if self.frames_read % self.report_every == 0:
+            self.print_log(f"Capture stats: {self.capture_stats()}")
+        return True, self.ring.latest()
+
+    # Returns counters of the frame grabber and the analysis loop
+    def capture_stats(self):
+        grabbed = self.last_seq
+        return {'frames grabbed': grabbed,
+                'frames analysed': self.frames_read,
+                'frames dropped': self.frames_dropped,
+                'dropped rate': self.frames_dropped / grabbed if grabbed else 0,
+                'mean latency': self.latency_total / self.frames_read if self.frames_read else 0,
+                'reconnects': self.reconnects + (self.grabber.reconnects if self.grabber else 0),
+                'noise': self.noise.stats() if self.noise else None}
     
     # Start looking for movement on the camera
     def start(self, end: threading.Event, mse_threshold=20, consequent_frames_threshold=4):
         ''' Starts looking for movement on a camera until stopped by main program
-            or an error occurs. When MSE between <n> consequent frames exceeds threshold,
+            or an error occurs. When MSE between <n> consequent frames exceeds threshold
+            (mse_threshold, or higher if adaptive threshold is on and the picture is noisy),
             the next 70 frames (~5 seconds) and 30 previous are recorded. When frames are finished recording,
             they are passed to Classifier which assigns a label. If the label is not empty, 
-            mp4 file is created and saved, and the database is updated'''
+            mp4 file is created and saved, and the database is updated.
+            Outside working hours the camera is disconnected and the thread sleeps until
+            shortly before the next working window'''
 
-        # Connect to the camera
-        self.print_log(f"Connecting to camera at {self.rtsp_url}")
-        self.cam = cv.VideoCapture(self.rtsp_url)
-        self.print_log(f"Finished connecting")
+        # Start the workers processing recorded clips
+        self.clip_queue = queueutils.ClipQueue(self.queue_size, self.queue_policy, on_drop=self.clip_dropped,
+                                               max_bytes=self.queue_memory, size=lambda clip: clip[0].nbytes)
+        workers = queueutils.ClipWorkers(self.clip_queue, lambda clip: self.process_frames(*clip), self.n_workers,
+                                         on_error=lambda e: self.print_log(f"Error while processing frames: {e}"))
+        workers.start()
 
-        frames_to_save = []
-        success, new_frame = self.read_frame()
-        consequent_frames = 0
-        to_be_saved = 0
-        frames_queue = [new_frame] * 30 # Fill the queue with the first frame
-        consequent_failed = 0 # Number of consequent frames that failed to load
-
-        # Keep reading new frames until either stopped by main program or error occurs
-        while self.cam.isOpened() and not end.is_set():
-            # If current time is not during working hours, skip the whole loop
-            current_time = datetime.datetime.now()
-            start_today = current_time.replace(hour=self.start_time.hour, minute=self.start_time.minute)
-            end_today = current_time.replace(hour=self.end_time.hour, minute=self.end_time.minute)
-            if (start_today < end_today and (current_time < start_today or end_today < current_time)) or (
-                start_today > end_today and (current_time < start_today and end_today < current_time)):
-                #self.print_log(f"Outside working hours, sleeping at {current_time}")
-                time.sleep(1) # Sleep to not load the CPU
+        while not end.is_set():
+            active, change = self.schedule.next_change()
+            if not active:
+                if change is None:
+                    self.stop_grabber()
+                    self.print_log("No working hours in the schedule")
+                    end.wait()
+                    break
+
+                # Wake up a bit earlier to connect and load the model before the window opens
+                # The schedule is checked again after waking up, in case the clock was changed meanwhile
+                sleep = schedutils.seconds_until(change) - self.warm_up_lead
+                if sleep > 0:
+                    # Free the camera while it isn't needed
+                    self.stop_grabber()
+                    self.print_log(f"Outside working hours, sleeping until {change}")
+                    end.wait(sleep)
+                    continue
+                self.classifier.warm_up()
+                self.start_grabber()
+                end.wait(max(0, schedutils.seconds_until(change)))
                 continue
 
-            # Update the number of consequent frames which exceeded MSE threshold (or reset to 0)
-            if self.mse(frames_queue[-1], frames_queue[-2]) > mse_threshold:
-                consequent_frames += 1
-            else:
-                consequent_frames = 0
-
-            # Queue 100 (30 previous + 70 next) frames to be saved if enough consequent frames show movement
-            if (consequent_frames > consequent_frames_threshold):
-                self.print_log("Queueing 100 frames to be saved")
-                to_be_saved = 100
-
-            # Save the current frame if queued
-            if to_be_saved > 0:
-                to_be_saved -= 1
-                frames_to_save.append(frames_queue[0])
-
-            # Process the frames when they are finished recording
-            elif len(frames_to_save) != 0:
-                self.print_log("Finished recording frames, starting processing")
-                self.process_frames(frames_to_save)
-                frames_to_save = []
-
-            # Read a new frame and update the queue
-            success, new_frame = self.read_frame()
-            if success:
-                consequent_failed = 0
-                frames_queue.append(new_frame)
-                frames_queue.pop(0)
-            else:
-                consequent_failed += 1
-                self.print_log("Failed to read new frame")
-                # Restart the camera if many frames couldn't be loaded
-                if consequent_failed > 3:
-                    self.cam.release()
-                    self.print_log("Reconnecting to camera")
-                    self.cam = cv.VideoCapture(self.rtsp_url)
-                    self.print_log("Reconnected successfully")
-                    consequent_failed = 0
-                
+            # Load the model while connecting, so the first clip doesn't wait for it
+            self.classifier.warm_up()
+            self.start_grabber()
+            self.print_log(f"Working until {change or 'stopped'}")
+            self.run_window(end, change, mse_threshold, consequent_frames_threshold)
+            if not self.grabber.is_alive():
+                break # The source has ended or failed for good
+
         self.print_log('Exiting camera')
-        self.cam.release()
+        if self.grabber is not None:
+            self.grabber.stop()
         cv.destroyAllWindows()
 
+        # Let the workers finish clips which are already recorded
+        self.print_log(f"Waiting for queued clips to be processed: {self.clip_queue.stats()}")
+        workers.stop()
+
+    # Connect to the camera unless already connected
+    def start_grabber(self):
+        if self.grabber is not None:
+            return
+        self.grabber = frameutils.FrameGrabber(self.rtsp_url, log=self.print_log, **self.source_options)
+        self.grabber.start()
+        self.last_seq = 0
+        # Frames from the previous window must not end up in clips or be compared with new ones
+        self.ring.clear()
+        self.motion.reset()
+
+    # Disconnect from the camera, so the device is released
+    def stop_grabber(self):
+        if self.grabber is None:
+            return
+        self.grabber.stop()
+        self.reconnects += self.grabber.reconnects
+        self.grabber = None
+
+    # Looks for movement until the window ends (window_end, None for never), the main program stops it
+    # or the camera fails. A clip which is being recorded when the window ends or a replayed file
+    # (reconnect=False in source_options) runs out of frames is processed as it is
+    def run_window(self, end, window_end, mse_threshold, consequent_frames_threshold):
+        # Compare against a monotonic clock, it is cheaper than datetime and doesn't jump
+        deadline = self.deadline(window_end)
+
+        success, new_frame = self.read_frame()
+        consequent_frames = 0
+        frame_mse = self.motion.update(new_frame) if success else 0 # MSE between the two newest frames
+        to_be_saved = 0 # Number of frames which still have to be recorded
+        clip_length = 0 # Number of frames in the ring buffer which belong to the current clip
+        recording = None # Video file the current clip is written to
+
+        try:
+            # Keep reading new frames until either stopped by main program or error occurs
+            # Frames the grabber published before it stopped are still analysed
+            while (self.grabber.is_alive() or self.grabber.seq > self.last_seq + self.skip_frames) and not end.is_set():
+                metricutils.profiler.check() # Start or stop profiling this thread if requested
+                if deadline is not None and time.monotonic() >= deadline:
+                    # Check the wall clock too, the window could have moved if the clock was changed meanwhile
+                    active, window_end = self.schedule.next_change()
+                    if not active:
+                        break
+                    deadline = self.deadline(window_end)
+
+                # Update the number of consequent frames which exceeded MSE threshold (or reset to 0)
+                threshold = self.noise.threshold(mse_threshold) if self.noise else mse_threshold
+                metricutils.metrics.set('motion threshold', threshold)
+                if frame_mse > threshold:
+                    consequent_frames += 1
+                else:
+                    consequent_frames = 0
+
+                # Record 100 (30 previous + 70 next) frames if enough consequent frames show movement
+                # Movement during the recording, or right when it finishes, extends it by another 70 frames
+                if (consequent_frames > consequent_frames_threshold):
+                    if to_be_saved == 0 and clip_length == 0:
+                        self.print_log("Queueing 100 frames to be saved")
+                        metricutils.metrics.count('motion triggers')
+                        clip_length = min(self.pre_roll, self.ring.count)
+                        recording = self.start_recording(clip_length)
+                    to_be_saved = self.post_roll
+
+                # Pass the frames to the workers when they are finished recording
+                if to_be_saved == 0 and clip_length > 0:
+                    self.print_log("Finished recording frames, queueing for processing")
+                    self.queue_clip(self.ring.snapshot(clip_length), recording)
+                    clip_length = 0
+                    recording = None
+
+                # Read a new frame into the ring buffer
+                success, new_frame = self.read_frame()
+                if success:
+                    with metricutils.metrics.timer('motion check'):
+                        frame_mse = self.motion.update(new_frame)
+                        # Learn the noise only from quiet frames, movement mustn't teach the threshold that it is noise
+                        if self.noise and consequent_frames == 0 and to_be_saved == 0:
+                            self.noise.update(frame_mse)
+                    metricutils.metrics.observe('frame mse', frame_mse)
+                    if to_be_saved > 0:
+                        to_be_saved -= 1
+                        clip_length += 1
+                        recording.write(new_frame)
+                        # The clip is about to be overwritten, pass it on and continue recording into a new one
+                        if clip_length == self.ring.capacity and to_be_saved > 0:
+                            self.print_log("Recording is too long, queueing frames for processing")
+                            self.queue_clip(self.ring.snapshot(clip_length), recording)
+                            clip_length = 0
+                            recording = None # The workers own it now
+                            recording = self.start_recording(0)
+                else:
+                    # The grabber reconnects by itself, just don't compare frames from different connections
+                    self.print_log("No new frames from the camera")
+                    self.motion.reset()
+
+        except BaseException:
+            # Don't leave an unfinished file and its writer thread behind
+            if recording is not None:
+                recording.discard()
+            raise
+
+        if recording is not None:
+            source_ended = self.grabber.finished and not self.grabber.reconnect # The end of a replayed file
+            if end.is_set() or not (self.grabber.is_alive() or source_ended) or clip_length == 0:
+                recording.discard() # The clip wasn't finished
+            else:
+                self.print_log("Working hours are over or the video ended, queueing the recorded frames for processing")
+                self.queue_clip(self.ring.snapshot(clip_length), recording)
+
+    # time.monotonic() value at a local time, None for None
+    def deadline(self, when):
+        return time.monotonic() + schedutils.seconds_until(when) if when is not None else None
+
+    # Starts writing a new video beginning with n last frames from the ring buffer
+    def start_recording(self, n_previous):
+        recording = self.db.start_video(self.fps, self.ring.latest().shape)
+        for i in reversed(range(n_previous)):
+            recording.write(self.ring.latest(i))
+        return recording
+
+    # Passes a recorded clip to the workers. A clip the queue doesn't take is discarded,
+    # a recording must always end up saved or discarded
+    def queue_clip(self, frames, recording):
+        if not self.clip_queue.put((frames, recording)):
+            recording.discard()
+
+    # Called when a recorded clip is thrown away because the workers can't keep up
+    def clip_dropped(self, clip):
+        frames, recording = clip
+        recording.discard()
+        self.print_log(f"Processing queue is full, dropped a clip: {self.clip_queue.stats()}")
+
+    # Returns counters of the processing queue
+    def queue_stats(self):
+        if self.clip_queue is None:
+            return None
+        return self.clip_queue.stats()
+
     # Classifies a video with neural net 
-    def process_frames(self, frames):
+    # If the video was already written to a file while recording, the file is renamed or deleted
+    def process_frames(self, frames, recording=None):
+        try:
+            self.label_clip(frames, recording)
+        except:
+            # A clip which fails mustn't leave its recording behind
+            if recording is not None:
+                recording.discard()
+            raise
+
+    def label_clip(self, frames, recording):
         # Get a prediction
-        pred = self.classifier.classify_video(frames)
-        self.print_log(f'Object labeled as {pred}')
+        with metricutils.metrics.timer('classify clip'):
+            result = self.classifier.classify_clip(frames, self.crop)
+        pred = result['label']
+        self.print_log(f"Object labeled as {pred} after {result['frames classified']} of {result['frames moving']} "
+                       f"moving frames, probabilities: {result['probabilities']}")
+        metricutils.metrics.observe('frames per clip', result['frames classified'])
+        metricutils.metrics.count('label ' + pred)
+        for label, probability in result['probabilities'].items():
+            metricutils.metrics.observe(f'probability {label} of {pred} clips', probability)
+        unix_time = int(time.time())
         
         # Save only cats and foxes
         if pred not in ('Cat', 'Fox'):
+            self.db.write_classification(unix_time, result)
+            if recording is not None:
+                recording.discard()
             return
         
-        unix_time = int(time.time())
         formatted_time = time.strftime("%d/%m/%y %H:%M:%S") # Date in more human-readable format
-        file_name_time = time.strftime("%d-%m-%y %Hh %Mm %Ss") # Time for file name
-        video_name = pred + " " + file_name_time
+        video_name = dbutils.video_name(pred) # Label and time, see dbutils.parse_video_name
+        self.db.write_classification(unix_time, result, video_name)
         self.db.write_record({'Unix time': unix_time, 
                               'Date': formatted_time, 
                               'Label': pred})
-        self.db.save_video(frames, video_name, self.fps)
+        if recording is not None:
+            recording.save(video_name)
+        else:
+            self.db.save_video(frames, video_name, self.fps)
 
 
 # Testing
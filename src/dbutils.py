@@ -1,13 +1,234 @@
 import csv
+import io
+import json
+import queue
 import threading
 import cv2 as cv
 import os
-import pandas as pd
 import random
+import sqlite3
 import time
+import numpy as np
+from src import metricutils
 
 DATABASE_PATH = './database.csv'
+SQLITE_PATH = './database.sqlite'
+SQLITE_MIGRATED = 1 # PRAGMA user_version of an SQLite database once the csv database is copied into it
+EDITS_SUFFIX = '.edits' # Label changes of the csv database are appended to DATABASE_PATH + EDITS_SUFFIX
+ROLLUPS_SUFFIX = '.rollups.json' # Record counts of the csv database are saved to DATABASE_PATH + ROLLUPS_SUFFIX
+ROLLUP_SECONDS = 1800 # Length of rollup buckets
+BACKENDS = ('csv', 'sqlite')
 VIDEOS_PATH = './videos/'
+CLASSIFICATIONS_PATH = './classifications.jsonl' # Label and class probabilities of every classified clip, one per line
+RECORDING_PREFIX = '.recording ' # Videos which are still being recorded start with this prefix
+
+
+# A video which is written to a temporary mp4 file frame by frame
+# and is either renamed to its final name or deleted when the recording is finished
+# Frames are copied into a queue and encoded by the recording's own thread, so the caller never waits for
+# the encoder. Only frames which weren't encoded yet are kept, normally a few at most (the pre-roll right after a trigger)
+class VideoRecording():
+    def __init__(self, path, fps, frame_shape):
+        self.path = path
+        height, width = frame_shape[:2]
+        fourcc = cv.VideoWriter_fourcc(*'mp4v')
+        self.video = cv.VideoWriter(path, fourcc, float(fps), (width, height))
+        self.n_frames = 0
+        self.frames = queue.Queue() # Copies of frames waiting to be encoded, None after the last one
+        self.discarded = False # Frames still waiting are thrown away
+        self.finished = False # The end of the video was queued, set only under finish_lock
+        self.finish_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.encode_loop, daemon=True, name='video-writer')
+        self.thread.start()
+
+    # Append a frame to the video. The frame is copied, so the caller can reuse its buffer right away
+    def write(self, frame):
+        self.frames.put(frame.copy())
+        self.n_frames += 1
+
+    # Main loop of the writer thread
+    def encode_loop(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            if not self.discarded:
+                with metricutils.metrics.timer('video encode'):
+                    self.video.write(frame)
+        self.video.release()
+
+    # Wait until all frames are encoded and the file is closed
+    # Can be called more than once, e.g. when a dropped clip is discarded twice
+    def finish(self):
+        with self.finish_lock:
+            if not self.finished:
+                self.finished = True
+                self.frames.put(None)
+        self.thread.join()
+
+    # Finish the video and move it to VIDEOS_PATH under a given name
+    def save(self, name):
+        with metricutils.metrics.timer('video save'):
+            self.finish()
+            os.replace(self.path, VIDEOS_PATH + name + '.mp4')
+
+    # Finish the video and delete it
+    def discard(self):
+        self.discarded = True
+        self.finish()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# Name of a saved video without the extension, e.g. "Fox 24-12-23 19h 53m 14s"
+def video_name(label, struct_time=None):
+    return label + " " + time.strftime("%d-%m-%y %Hh %Mm %Ss", struct_time or time.localtime())
+
+# Returns the label and the unix time of a saved video from its file name, or None if it isn't a saved video
+def parse_video_name(file_name):
+    if file_name.startswith(RECORDING_PREFIX) or not file_name.endswith('.mp4') or ' ' not in file_name:
+        return None
+    label, file_name_time = file_name[:-4].split(' ', 1)
+    try:
+        return label, int(time.mktime(time.strptime(file_name_time, "%d-%m-%y %Hh %Mm %Ss")))
+    except ValueError:
+        return None
+
+
+# Records stored as columns: unix times and label codes, labels[code] is the label of a record
+# Takes a fraction of the memory of a list of dictionaries and can be aggregated with numpy
+# Columns are never changed once created (only the label list grows), so they can be shared between threads
+class RecordColumns():
+    def __init__(self, times=None, codes=None, labels=None):
+        self.times = times if times is not None else np.zeros(0, dtype=np.int64)
+        self.codes = codes if codes is not None else np.zeros(0, dtype=np.int16)
+        self.labels = labels if labels is not None else []
+        # Index for time queries, built by sort_index when needed: record indices sorted by time and sorted times
+        self.order = None
+        self.sorted_times = None
+
+    def __len__(self):
+        return len(self.times)
+
+    # Returns the code of a label, a new label gets the next code
+    def code(self, label):
+        if label not in self.labels:
+            self.labels.append(label)
+        return self.labels.index(label)
+
+    # Returns new columns with records added to the end
+    def appended(self, times, labels):
+        uniques, inverse = np.unique(np.asarray(labels, dtype=str), return_inverse=True)
+        mapping = np.array([self.code(str(label)) for label in uniques], dtype=np.int16)
+        times = np.asarray(times, dtype=np.int64)
+        result = RecordColumns(np.concatenate([self.times, times]),
+                               np.concatenate([self.codes, mapping[inverse.reshape(-1)]]), self.labels)
+        # Records usually arrive in time order, then the index is only extended
+        if self.order is not None and np.all(np.diff(times) >= 0) and (
+                len(self) == 0 or len(times) == 0 or times[0] >= self.sorted_times[-1]):
+            result.sorted_times = np.concatenate([self.sorted_times, times])
+            result.order = np.concatenate([self.order, np.arange(len(self), len(result))])
+        return result
+
+    # Returns new columns with edits applied, edits are {unix time: label or None if deleted}
+    def with_edits(self, edits):
+        if len(edits) == 0 or len(self) == 0:
+            return self
+        keys = np.array(sorted(edits), dtype=np.int64)
+        new_codes = np.array([-1 if edits[key] is None else self.code(edits[key]) for key in keys.tolist()],
+                             dtype=np.int16)
+        # Find every time among the edited times with a binary search
+        index = np.minimum(np.searchsorted(keys, self.times), len(keys) - 1)
+        matched = keys[index] == self.times
+        codes = self.codes.copy()
+        codes[matched] = new_codes[index[matched]]
+        kept = codes >= 0
+        edited = RecordColumns(self.times[kept], codes[kept], self.labels)
+        if self.order is not None:
+            # Keep the sorted index, renumbered without the deleted records
+            new_index = np.cumsum(kept) - 1
+            order = new_index[self.order[kept[self.order]]]
+            edited.sorted_times = edited.times[order]
+            edited.order = order
+        return edited
+
+    # Build the index of records sorted by time if it doesn't exist yet
+    def sort_index(self):
+        if self.order is None:
+            # Sorted times are set first, another thread may use the index as soon as order is set
+            order = np.argsort(self.times, kind='stable')
+            self.sorted_times = self.times[order]
+            self.order = order
+
+    # Returns records between start and end (inclusive, None for no limit) with one of the labels
+    # (None for all labels), sorted by time. Found with a binary search, so the cost depends only on the result
+    def range(self, start=None, end=None, labels=None):
+        self.sort_index()
+        lo = 0 if start is None else np.searchsorted(self.sorted_times, start, 'left')
+        hi = len(self) if end is None else np.searchsorted(self.sorted_times, end, 'right')
+        indices = self.order[lo:hi]
+        if labels is not None:
+            codes = [self.labels.index(label) for label in labels if label in self.labels]
+            indices = indices[np.isin(self.codes[indices], codes)]
+        return RecordColumns(self.times[indices], self.codes[indices], self.labels)
+
+    # Labels of all records as a list of strings
+    def label_list(self):
+        return np.array(self.labels, dtype=object)[self.codes].tolist()
+
+
+# Numbers of records of every label in ROLLUP_SECONDS long buckets, so statistics don't have to go
+# through every record. Records exactly at the start of a bucket are also counted separately: when times are rounded
+# to the nearest hour, day etc. (see StatisticsMenu), they can be rounded the other way than the rest of the bucket
+class Rollups():
+    def __init__(self, counts=None):
+        self.counts = counts if counts is not None else {} # {label: {bucket: [records, records at the start]}}
+
+    # Add n records (negative to remove them)
+    def add(self, unix_time, label, n=1):
+        bucket, offset = divmod(int(unix_time), ROLLUP_SECONDS)
+        counts = self.counts.setdefault(label, {}).setdefault(bucket, [0, 0])
+        counts[0] += n
+        if offset == 0:
+            counts[1] += n
+        if counts[0] == 0:
+            del self.counts[label][bucket]
+
+    @staticmethod
+    def from_columns(columns: RecordColumns):
+        rollups = Rollups()
+        buckets, offsets = np.divmod(columns.times, ROLLUP_SECONDS)
+        for code, label in enumerate(columns.labels):
+            selected = columns.codes == code
+            label_counts = {}
+            for bucket, n in zip(*(array.tolist() for array in np.unique(buckets[selected], return_counts=True))):
+                label_counts[bucket] = [n, 0]
+            starts = np.unique(buckets[selected & (offsets == 0)], return_counts=True)
+            for bucket, n in zip(*(array.tolist() for array in starts)):
+                label_counts[bucket][1] = n
+            if len(label_counts) > 0:
+                rollups.counts[label] = label_counts
+        return rollups
+
+    # Rollups from (label, bucket, records, records at the start) rows
+    @staticmethod
+    def from_rows(rows):
+        rollups = Rollups()
+        for label, bucket, n, n_start in rows:
+            rollups.counts.setdefault(label, {})[bucket] = [n, n_start]
+        return rollups
+
+    # Returns {label: (bucket numbers, records, records at the start of buckets)} as arrays sorted by bucket
+    # The arrays are a copy, so they can be used while records are added
+    def snapshot(self, labels=None):
+        result = {}
+        for label in (labels if labels is not None else list(self.counts)):
+            items = sorted(self.counts.get(label, {}).items())
+            buckets = np.array([bucket for bucket, _ in items], dtype=np.int64)
+            counts = np.array([counts for _, counts in items], dtype=np.int64).reshape(-1, 2)
+            result[label] = (buckets, counts[:, 0], counts[:, 1])
+        return result
+
 
 # Stores records of foxes and other animals
 class Database():
@@ -15,28 +236,266 @@ class Database():
         self.lock = threading.Lock()
         self.log = log
         self.header = ['Unix time', 'Date', 'Label']
+        self.recordings_count = 0 # Used to give unique names to temporary video files
+
+        # Label changes are appended to an edit log and applied when records are read
+        # Once the log grows over compact_size bytes, it is merged into the database in a background thread
+        self.compact_size = 64 * 1024
+        self.compact_lock = threading.Lock() # Only one compaction at a time
+
+        # New records are buffered and written in groups: when flush_size records are waiting,
+        # flush_interval seconds after the first of them arrived, or on flush() and close()
+        self.buffer = []
+        self.flush_size = 100
+        self.flush_interval = 1.0
+        self.flush_timer = None
+        self.file = None # The csv file is kept open between writes
+        self.writer = None
+
+        # Records loaded by read_columns, reused until the file changes
+        self.columns_cache = None
+
+        # Record counts for statistics, see Rollups. They are loaded from the rollup file or built from records
+        # when they are needed for the first time, and then updated by every change. rollups_stamp describes
+        # the files they match, if the files are changed by someone else, the rollups are built again
+        self.rollups = None
+        self.rollups_stamp = None
+        self.rollups_file_checked = False # The rollup file is only useful when the program starts
 
     def print_log(self, message):
         if self.log:
             print(message)
 
-    # Save a record into the end of csv file
+    # Save a record into the end of csv file. The record is buffered, see flush
     def write_record(self, record: dict):
-        # Acquire the lock to prevent a race condition and open the database
-        with self.lock, open(DATABASE_PATH, 'a', newline='') as file: 
-            writer = csv.DictWriter(file, delimiter=',', 
-                                    quoting=csv.QUOTE_MINIMAL, fieldnames=self.header)
-            writer.writerow(record)
+        # Acquire the lock to prevent a race condition
+        with metricutils.metrics.timer('db write'), self.lock:
+            self.buffer.append(record)
+            if len(self.buffer) >= self.flush_size:
+                self.flush_buffer()
+            elif self.flush_timer is None:
+                self.flush_timer = threading.Timer(self.flush_interval, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+
+    # Save many records at once
+    def write_records(self, records):
+        with metricutils.metrics.timer('db write'), self.lock:
+            self.buffer.extend(records)
+            self.flush_buffer()
+
+    # Write buffered records to the disk
+    def flush(self):
+        with self.lock:
+            self.flush_buffer()
+
+    # Same as flush, but the caller must hold the lock
+    def flush_buffer(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        if len(self.buffer) == 0:
+            return
+        rollups = self.load_rollups(rebuild=False)
+        with metricutils.metrics.timer('db flush'):
+            self.write_rows(self.buffer)
+        if rollups is not None:
+            for record in self.buffer:
+                rollups.add(record['Unix time'], record['Label'])
+            self.rollups_stamp = self.stamp()
+        self.buffer = [] # Kept if writing failed, so the next flush tries again
+
+    # Append records to the csv file and make sure they reach the disk
+    def write_rows(self, records):
+        # Another process may have compacted the database, rows written to the old file would be lost
+        if self.file is not None and self.file_replaced():
+            self.close_file()
+        if self.file is None:
+            self.file = open(DATABASE_PATH, 'a', newline='')
+            self.writer = csv.DictWriter(self.file, delimiter=',',
+                                         quoting=csv.QUOTE_MINIMAL, fieldnames=self.header)
+        self.writer.writerows(records)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    # Whether the open csv file is no longer the one at DATABASE_PATH
+    def file_replaced(self):
+        try:
+            return os.fstat(self.file.fileno()).st_ino != os.stat(DATABASE_PATH).st_ino
+        except FileNotFoundError:
+            return True
+
+    # Close the csv file, it must be reopened after the file is replaced
+    def close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.writer = None
 
     # Get records as a list of dictionaries
     def read_records(self):
         records = []
         # Acquire the lock to prevent a race condition and open the database
-        with self.lock, open(DATABASE_PATH, 'r', newline='') as file:
-            reader = csv.DictReader(file, delimiter=',', quoting=csv.QUOTE_MINIMAL)
-            for row in reader:
-                records.append(row)
+        with self.lock:
+            self.flush_buffer()
+            with open(DATABASE_PATH, 'r', newline='') as file:
+                edits = self.read_edits()
+                reader = csv.DictReader(file, delimiter=',', quoting=csv.QUOTE_MINIMAL)
+                for row in self.apply_edits(reader, edits):
+                    records.append(row)
         return records
+
+    # Get records as columns, see RecordColumns. The result is shared and must not be modified
+    # It is cached: the file is parsed again only if it was replaced or rewritten, otherwise only records
+    # appended since the last call are read
+    def read_columns(self):
+        with self.lock, metricutils.metrics.timer('db load'):
+            return self.load_columns()
+
+    # Same as read_columns, but the caller must hold the lock
+    def load_columns(self):
+        cache = self.load_edits(self.load_raw_columns())
+        if cache['edited'] is None:
+            cache['edited'] = cache['columns'].with_edits(cache['edit_map'])
+        return cache['edited']
+
+    # Reads new records into the cache of records without the edit log applied and returns the cache
+    # The caller must hold the lock
+    def load_raw_columns(self):
+        self.flush_buffer()
+        stat = os.stat(DATABASE_PATH)
+        cache = self.columns_cache
+        if (cache is None or cache['file'] != (DATABASE_PATH, stat.st_ino) or stat.st_size < cache['size']
+                or (stat.st_size == cache['size'] and stat.st_mtime_ns != cache['mtime'])):
+            cache = {'file': (DATABASE_PATH, stat.st_ino), 'size': 0, 'mtime': None,
+                     'columns': RecordColumns(), 'edits': None, 'edit_map': {}, 'edited': None}
+        if stat.st_size > cache['size']:
+            self.read_tail(cache, stat.st_size)
+            cache['edited'] = None
+        cache['mtime'] = stat.st_mtime_ns
+        self.columns_cache = cache
+        return cache
+
+    # The edit log is small, so it is read again whenever it changes
+    def load_edits(self, cache):
+        edits_key = self.edits_key()
+        if cache['edits'] != edits_key:
+            cache['edit_map'] = self.read_edits(edits_key[0] if edits_key else None)
+            cache['edits'] = edits_key
+            cache['edited'] = None
+        return cache
+
+    # Size and modification time of the edit log, None if there is none
+    def edits_key(self):
+        if not os.path.exists(self.edits_path()):
+            return None
+        stat = os.stat(self.edits_path())
+        return stat.st_size, stat.st_mtime_ns
+
+    # Returns records between start and end unix times (inclusive, None for no limit) with one of the labels
+    # (None for all labels) as RecordColumns sorted by time
+    def query(self, start=None, end=None, labels=None):
+        return self.read_columns().range(start, end, labels)
+
+    # Returns counts of records in buckets, see Rollups.snapshot
+    def read_rollups(self, labels=None):
+        with self.lock, metricutils.metrics.timer('db rollups'):
+            self.flush_buffer()
+            return self.load_rollups(rebuild=True).snapshot(labels)
+
+    # Returns rollups which match the database files, the caller must hold the lock
+    # If they aren't loaded yet or the files were changed by someone else, they are read from the rollup file,
+    # or built from records if rebuild is True. Otherwise returns None
+    def load_rollups(self, rebuild):
+        stamp = self.stamp()
+        if self.rollups is not None and self.rollups_stamp != stamp:
+            self.rollups = None
+        if self.rollups is None and not self.rollups_file_checked and os.path.exists(self.rollups_path()):
+            self.rollups_file_checked = True
+            with open(self.rollups_path()) as file:
+                saved = json.load(file)
+            if saved['stamp'] == stamp:
+                self.rollups = Rollups.from_rows((label, bucket, n, n_start) for label, counts in saved['counts'].items()
+                                                 for bucket, n, n_start in counts)
+                self.rollups_stamp = stamp
+        if self.rollups is None and rebuild:
+            self.rollups = Rollups.from_columns(self.load_columns())
+            self.rollups_stamp = self.stamp()
+            self.print_log(f"Built rollups of {len(self.columns_cache['edited'])} records")
+        return self.rollups
+
+    # Write the rollups next to the database, so the next start doesn't have to build them
+    # The caller must hold the lock
+    def save_rollups(self):
+        if self.rollups is None:
+            return
+        saved = {'stamp': self.rollups_stamp,
+                 'counts': {label: [[bucket, n, n_start] for bucket, (n, n_start) in counts.items()]
+                            for label, counts in self.rollups.counts.items()}}
+        with open(self.rollups_path() + '.tmp', 'w') as file:
+            json.dump(saved, file)
+        os.replace(self.rollups_path() + '.tmp', self.rollups_path())
+
+    def rollups_path(self):
+        return DATABASE_PATH + ROLLUPS_SUFFIX
+
+    # Sizes and modification times of the database and the edit log, they change with every write
+    def stamp(self):
+        stamp = []
+        for path in (DATABASE_PATH, self.edits_path()):
+            stat = os.stat(path) if os.path.exists(path) else None
+            stamp.append([stat.st_size, stat.st_mtime_ns] if stat else None)
+        return stamp
+
+    # Returns records with the given unix time as a list of dictionaries with 'Unix time' and 'Label'
+    def find(self, unix_time):
+        found = self.query(unix_time, unix_time)
+        return [{'Unix time': time, 'Label': label} for time, label in zip(found.times.tolist(), found.label_list())]
+
+    # Parse records between the end of the cached part and size into the cache
+    def read_tail(self, cache, size):
+        import pandas as pd # Only the statistics need it, so it is imported on first use
+        with open(DATABASE_PATH, 'rb') as file:
+            file.seek(cache['size'])
+            data = file.read(size - cache['size'])
+        data = data[:data.rfind(b'\n') + 1] # A line which is still being written is read next time
+        if len(data) > 0:
+            frame = pd.read_csv(io.BytesIO(data), header=0 if cache['size'] == 0 else None, names=self.header,
+                                usecols=['Unix time', 'Label'], dtype={'Unix time': np.int64, 'Label': str},
+                                keep_default_na=False)
+            cache['columns'] = cache['columns'].appended(frame['Unix time'].to_numpy(), frame['Label'].to_numpy())
+        cache['size'] += len(data)
+
+    def edits_path(self):
+        return DATABASE_PATH + EDITS_SUFFIX
+
+    # Returns the final label of every edited record, {unix time: label or None if deleted}
+    # Only the first size bytes of the log are read if size is given
+    def read_edits(self, size=None, path=None):
+        path = path or self.edits_path()
+        edits = {}
+        if not os.path.exists(path):
+            return edits
+        with open(path, 'rb') as file:
+            text = file.read(size if size is not None else -1).decode()
+        for row in csv.reader(io.StringIO(text, newline='')):
+            if len(row) != 2 or not row[0].isdigit():
+                continue # The line was being written during a crash
+            unix_time = int(row[0])
+            if edits.get(unix_time, '') is not None: # A deleted record stays deleted
+                edits[unix_time] = row[1] or None
+        return edits
+
+    # Yields rows with edits applied
+    @staticmethod
+    def apply_edits(rows, edits):
+        for row in rows:
+            unix_time = int(row['Unix time'])
+            if unix_time in edits:
+                if edits[unix_time] is None: # Deleted
+                    continue
+                row['Label'] = edits[unix_time]
+            yield row
     
     # Converts a list of frames to mp4 video and saves it
     def save_video(self, frames: list, name, fps):
@@ -50,43 +509,341 @@ class Database():
 
         # Create the video
         try:
+            start = time.perf_counter()
             video = cv.VideoWriter(VIDEOS_PATH + name + '.mp4', fourcc, float(fps), (width, height))
             for frame in frames:
                 video.write(frame)
+            video.release()
+            metricutils.metrics.observe('video save', time.perf_counter() - start)
             self.print_log("Finished saving")
         except:
             self.print_log(f"Error occurred during saving, skipping")
 
+    # Append the result of classifying a clip (see camutils.ClipClassification.result) to CLASSIFICATIONS_PATH
+    # video_name is the name of the saved video, None if the clip wasn't saved
+    def write_classification(self, unix_time, result, video_name=None):
+        line = json.dumps({'Unix time': unix_time, 'Video': video_name, **result})
+        with self.lock, open(CLASSIFICATIONS_PATH, 'a') as file:
+            file.write(line + '\n')
+
+    # Start writing a new video frame by frame. See VideoRecording
+    def start_video(self, fps, frame_shape):
+        os.makedirs(VIDEOS_PATH, exist_ok=True) # Make sure the directory exists
+        with self.lock:
+            self.recordings_count += 1
+            path = f"{VIDEOS_PATH}{RECORDING_PREFIX}{os.getpid()} {self.recordings_count}.mp4"
+        self.print_log(f"Started recording a video to {path}")
+        return VideoRecording(path, fps, frame_shape)
+
     # Delete the database
     def delete_database(self):
-        with self.lock, open(DATABASE_PATH, 'w') as file:
-            writer = csv.DictWriter(file, delimiter=',', 
-                                    quoting=csv.QUOTE_MINIMAL, fieldnames=self.header)
-            writer.writeheader()
+        with self.lock:
+            self.buffer = [] # Buffered records are deleted too
+            self.flush_buffer()
+            self.close_file()
+            with open(DATABASE_PATH, 'w') as file:
+                writer = csv.DictWriter(file, delimiter=',', 
+                                        quoting=csv.QUOTE_MINIMAL, fieldnames=self.header)
+                writer.writeheader()
+            if os.path.exists(self.edits_path()):
+                os.remove(self.edits_path())
+            self.columns_cache = None
+            self.rollups = Rollups()
+            self.rollups_stamp = self.stamp()
+            self.rollups_file_checked = True
             self.print_log('Database deleted')
 
     # Change label with corresponding unix_time to another label
     def change_label(self, unix_time, new_label, delete=False):
-        rows = self.read_records()
-        self.delete_database() # Delete and rewrite the whole database
-        for row in rows:
-            if int(row['Unix time']) == unix_time:
-                if delete: # Don't add the row if it should be deleted
-                    continue
-                row['Label'] = new_label
-            self.write_record(row)
+        self.change_labels({unix_time: None if delete else new_label})
+
+    # Change labels of many records at once. changes maps unix time to a new label, or to None to delete the record
+    # The changes are only appended to the edit log, so the cost doesn't depend on the size of the database
+    # Returns the number of records changed, or None if the records aren't loaded and so weren't counted
+    def change_labels(self, changes: dict):
+        with self.lock:
+            # Count the records which are changed and move them to their new labels in the rollups, if they are loaded
+            # They are found in the loaded records and the edit log, the edited records aren't built again
+            rollups = self.load_rollups(rebuild=False)
+            n_changed = None
+            if rollups is not None or self.columns_cache is not None:
+                cache = self.load_edits(self.load_raw_columns())
+                n_changed = 0
+                for unix_time, label in changes.items():
+                    old_labels = cache['columns'].range(unix_time, unix_time).label_list()
+                    if unix_time in cache['edit_map']:
+                        edited_label = cache['edit_map'][unix_time]
+                        old_labels = [edited_label] * len(old_labels) if edited_label is not None else []
+                    n_changed += len(old_labels)
+                    if rollups is not None:
+                        for old_label in old_labels:
+                            rollups.add(unix_time, old_label, -1)
+                            if label is not None:
+                                rollups.add(unix_time, label)
+
+            edits_key = self.edits_key()
+            with open(self.edits_path(), 'a', newline='') as file:
+                log_start = file.tell()
+                writer = csv.writer(file, delimiter=',', quoting=csv.QUOTE_MINIMAL)
+                writer.writerows((unix_time, label or '') for unix_time, label in changes.items())
+                file.flush()
+                os.fsync(file.fileno()) # Edits can't be recreated, unlike a missed record
+                log_size = file.tell()
+
+            # Add the changes to the cached edit log, unless someone else wrote to it meanwhile
+            # The edited records are built again only when they are read
+            cache = self.columns_cache
+            if cache is not None:
+                if cache['edits'] == edits_key and (edits_key[0] if edits_key else 0) == log_start:
+                    for unix_time, label in changes.items():
+                        if cache['edit_map'].get(unix_time, '') is not None: # A deleted record stays deleted
+                            cache['edit_map'][unix_time] = label
+                    cache['edits'] = self.edits_key()
+                cache['edited'] = None
+            if rollups is not None:
+                self.rollups_stamp = self.stamp()
+        if n_changed is None:
+            self.print_log(f"Logged {len(changes)} label changes")
+        else:
+            self.print_log(f"Logged {len(changes)} label changes of {n_changed} records")
+
+        if log_size > self.compact_size and not self.compact_lock.locked():
+            threading.Thread(target=self.compact, daemon=True, name='database-compaction').start()
+        return n_changed
+
+    # Merge the edit log into the database
+    # The database is rewritten into a temporary file without holding the lock, records and edits
+    # written meanwhile are carried over and the files are replaced at the end. Applying an edit twice changes
+    # nothing, so a crash at any point leaves a correct database
+    def compact(self):
+        with self.compact_lock:
+            with self.lock:
+                if not os.path.exists(self.edits_path()):
+                    return
+                database_size = os.path.getsize(DATABASE_PATH)
+                edits_size = os.path.getsize(self.edits_path())
+
+            start = time.perf_counter()
+            edits = self.read_edits(edits_size)
+            with open(DATABASE_PATH, 'rb') as file:
+                text = file.read(database_size).decode()
+            with open(DATABASE_PATH + '.tmp', 'w', newline='') as file:
+                writer = csv.DictWriter(file, delimiter=',',
+                                        quoting=csv.QUOTE_MINIMAL, fieldnames=self.header)
+                writer.writeheader()
+                reader = csv.DictReader(io.StringIO(text, newline=''), delimiter=',', quoting=csv.QUOTE_MINIMAL)
+                writer.writerows(self.apply_edits(reader, edits))
+
+            with self.lock:
+                # Records written during the compaction
+                self.flush_buffer()
+                self.close_file()
+                with open(DATABASE_PATH, 'rb') as old_file, open(DATABASE_PATH + '.tmp', 'ab') as file:
+                    old_file.seek(database_size)
+                    file.write(old_file.read())
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(DATABASE_PATH + '.tmp', DATABASE_PATH)
+
+                # Edits logged during the compaction stay in the log
+                with open(self.edits_path(), 'rb') as old_file, open(self.edits_path() + '.tmp', 'wb') as file:
+                    old_file.seek(edits_size)
+                    file.write(old_file.read())
+                os.replace(self.edits_path() + '.tmp', self.edits_path())
+                self.columns_cache = None
+                if self.rollups is not None:
+                    self.rollups_stamp = self.stamp() # The records are the same, only the files changed
+                    self.save_rollups()
+            metricutils.metrics.observe('db compaction', time.perf_counter() - start)
+            self.print_log(f"Compacted {len(edits)} label changes into the database")
 
     # Put random entries in database
     def random_database(self, n):
         self.delete_database()
-        for i in range(n):
-            unix_time = random.randint(0, 50000000)
-            date = 'N/A'
-            label = random.choice(['Fox', 'Cat'])
-            self.write_record({'Unix time': unix_time,
-                               'Date': date,
-                               'Label': label})
-            
+        self.write_records({'Unix time': random.randint(0, 50000000),
+                            'Date': 'N/A',
+                            'Label': random.choice(['Fox', 'Cat'])} for i in range(n))
+
+    # Write buffered records and close the database. Must be called before the program exits
+    def close(self):
+        with self.lock:
+            self.flush_buffer()
+            self.close_file()
+            if self.rollups is not None and self.rollups_stamp == self.stamp():
+                self.save_rollups()
+
+
+# Stores the same records as Database in an SQLite file instead of csv
+# Records are indexed by time and label, so edits and reads of a part of them don't touch the whole file
+# On the first start records from the csv database are copied into it
+class SqliteDatabase(Database):
+    def __init__(self, log=False, path=None):
+        super().__init__(log)
+        self.path = path or SQLITE_PATH
+
+        # One connection shared by all threads, self.lock makes sure only one of them uses it at a time
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL') # Readers don't wait for writers
+        self.connection.execute('PRAGMA synchronous=NORMAL') # Still safe against crashes in WAL mode
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS records '
+                                    '(unix_time INTEGER NOT NULL, date TEXT, label TEXT)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS records_time ON records (unix_time)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS records_label ON records (label, unix_time)')
+
+            # Rollups are kept in a table which triggers update in the same transaction as the records
+            new_rollups = self.connection.execute("SELECT name FROM sqlite_master WHERE name = 'rollups'").fetchone() is None
+            self.connection.execute('CREATE TABLE IF NOT EXISTS rollups (label TEXT, bucket INTEGER, count INTEGER, '
+                                    'start_count INTEGER, PRIMARY KEY (label, bucket))')
+            add = ('INSERT INTO rollups VALUES ({0}.label, {0}.unix_time / {1}, 1, {0}.unix_time % {1} = 0) '
+                   'ON CONFLICT (label, bucket) DO UPDATE SET count = count + 1, '
+                   'start_count = start_count + ({0}.unix_time % {1} = 0);')
+            remove = ('UPDATE rollups SET count = count - 1, start_count = start_count - ({0}.unix_time % {1} = 0) '
+                      'WHERE label = {0}.label AND bucket = {0}.unix_time / {1};')
+            self.connection.execute('CREATE TRIGGER IF NOT EXISTS rollups_insert AFTER INSERT ON records BEGIN '
+                                    + add.format('NEW', ROLLUP_SECONDS) + ' END')
+            self.connection.execute('CREATE TRIGGER IF NOT EXISTS rollups_delete AFTER DELETE ON records BEGIN '
+                                    + remove.format('OLD', ROLLUP_SECONDS) + ' END')
+            self.connection.execute('CREATE TRIGGER IF NOT EXISTS rollups_update AFTER UPDATE ON records BEGIN '
+                                    + remove.format('OLD', ROLLUP_SECONDS) + ' '
+                                    + add.format('NEW', ROLLUP_SECONDS) + ' END')
+            if new_rollups: # Records written before rollups existed
+                self.connection.execute(f'INSERT INTO rollups SELECT label, unix_time / {ROLLUP_SECONDS}, COUNT(*), '
+                                        f'SUM(unix_time % {ROLLUP_SECONDS} = 0) FROM records GROUP BY 1, 2')
+
+        # The csv database is copied in the same transaction which sets user_version, so a migration which was
+        # interrupted is done again on the next start. Databases made before user_version was set count as migrated
+        # if they have any records
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] < SQLITE_MIGRATED:
+            empty = self.connection.execute('SELECT NOT EXISTS (SELECT 1 FROM records)').fetchone()[0]
+            if empty and os.path.exists(DATABASE_PATH):
+                n_records = self.import_csv(DATABASE_PATH)
+                self.print_log(f"Copied {n_records} records from {DATABASE_PATH} to {self.path}")
+            else:
+                with self.connection:
+                    self.connection.execute(f'PRAGMA user_version = {SQLITE_MIGRATED}')
+
+    # Rows in the same format as records
+    @staticmethod
+    def to_row(record: dict):
+        return (int(record['Unix time']), record['Date'], record['Label'])
+
+    # Insert buffered records in one transaction
+    def write_rows(self, records):
+        with self.connection:
+            self.connection.executemany('INSERT INTO records VALUES (?, ?, ?)', map(self.to_row, records))
+
+    # Get records as a list of dictionaries, in the order they were written
+    def read_records(self):
+        with self.lock:
+            self.flush_buffer()
+            rows = self.connection.execute('SELECT unix_time, date, label FROM records ORDER BY rowid').fetchall()
+        return [{'Unix time': unix_time, 'Date': date, 'Label': label} for unix_time, date, label in rows]
+
+    # Records are loaded by rowid, so only new rows are read. Changes made by other connections
+    # are noticed through data_version, changes made here reset the cache
+    def read_columns(self):
+        with self.lock, metricutils.metrics.timer('db load'):
+            self.flush_buffer()
+            version = self.connection.execute('PRAGMA data_version').fetchone()[0]
+            if self.columns_cache is None or self.columns_cache['version'] != version:
+                self.columns_cache = {'version': version, 'rowid': 0, 'columns': RecordColumns()}
+            cache = self.columns_cache
+            rows = self.connection.execute('SELECT rowid, unix_time, label FROM records WHERE rowid > ? ORDER BY rowid',
+                                           (cache['rowid'],)).fetchall()
+            if len(rows) > 0:
+                rowids, times, labels = zip(*rows)
+                cache['columns'] = cache['columns'].appended(times, labels)
+                cache['rowid'] = rowids[-1]
+            return cache['columns']
+
+    # Selected by SQL, using the index on time or on label and time
+    def query(self, start=None, end=None, labels=None):
+        conditions, parameters = [], []
+        if start is not None:
+            conditions.append('unix_time >= ?')
+            parameters.append(start)
+        if end is not None:
+            conditions.append('unix_time <= ?')
+            parameters.append(end)
+        if labels is not None:
+            conditions.append(f"label IN ({', '.join('?' * len(labels))})")
+            parameters += labels
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        with self.lock:
+            self.flush_buffer()
+            rows = self.connection.execute(f'SELECT unix_time, label FROM records{where} ORDER BY unix_time, rowid',
+                                           parameters).fetchall()
+        times, labels = zip(*rows) if len(rows) > 0 else ((), ())
+        return RecordColumns().appended(times, labels)
+
+    # Rollups are maintained by triggers, see __init__
+    def read_rollups(self, labels=None):
+        with self.lock, metricutils.metrics.timer('db rollups'):
+            self.flush_buffer()
+            rows = self.connection.execute('SELECT label, bucket, count, start_count FROM rollups '
+                                           'WHERE count > 0').fetchall()
+        return Rollups.from_rows(rows).snapshot(labels)
+
+    def load_rollups(self, rebuild):
+        return None # Never loaded into memory
+
+    def delete_database(self):
+        with self.lock, self.connection:
+            self.buffer = [] # Buffered records are deleted too
+            self.flush_buffer()
+            self.connection.execute('DELETE FROM records')
+            self.connection.execute('DELETE FROM rollups')
+            self.columns_cache = None
+        self.print_log('Database deleted')
+
+    # All changes are made in one transaction
+    def change_labels(self, changes: dict):
+        deleted = [(unix_time,) for unix_time, label in changes.items() if label is None]
+        changed = [(label, unix_time) for unix_time, label in changes.items() if label is not None]
+        with self.lock:
+            self.flush_buffer() # Buffered records can be changed too
+            with self.connection:
+                # rowcount doesn't include rows changed by the rollup triggers, unlike total_changes
+                n_changed = self.connection.executemany('DELETE FROM records WHERE unix_time = ?', deleted).rowcount
+                n_changed += self.connection.executemany('UPDATE records SET label = ? WHERE unix_time = ?',
+                                                         changed).rowcount
+            self.columns_cache = None
+        self.print_log(f"Changed {n_changed} records")
+        return n_changed
+
+    # Add records from a csv database, with its edit log applied, and mark the database as migrated
+    # Returns the number of records
+    def import_csv(self, path):
+        edits = self.read_edits(path=path + EDITS_SUFFIX)
+        with open(path, 'r', newline='') as file:
+            reader = csv.DictReader(file, delimiter=',', quoting=csv.QUOTE_MINIMAL)
+            rows = [self.to_row(record) for record in self.apply_edits(reader, edits)]
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT INTO records VALUES (?, ?, ?)', rows)
+            self.connection.execute(f'PRAGMA user_version = {SQLITE_MIGRATED}')
+        return len(rows)
+
+    # Write all records to a csv file which Database can read (DATABASE_PATH by default)
+    def export_csv(self, path=None):
+        path = path or DATABASE_PATH
+        with open(path + '.tmp', 'w', newline='') as file:
+            writer = csv.DictWriter(file, delimiter=',', quoting=csv.QUOTE_MINIMAL, fieldnames=self.header)
+            writer.writeheader()
+            writer.writerows(self.read_records())
+        os.replace(path + '.tmp', path)
+
+    def close(self):
+        with self.lock:
+            self.flush_buffer()
+            self.connection.close()
+
+
+# Returns a database with the given backend, one of BACKENDS
+def open_database(backend='csv', log=False):
+    assert backend in BACKENDS, f"Unknown database backend: {backend}"
+    return SqliteDatabase(log) if backend == 'sqlite' else Database(log)
+
 
 # Testing
 if __name__ == "__main__":
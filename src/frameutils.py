@@ -0,0 +1,186 @@
+import threading
+import time
+import cv2 as cv
+import numpy as np
+from src import metricutils
+
+# Fixed-capacity ring buffer of frames stored in one contiguous (N, H, W, C) array
+# Memory is allocated once, when the first frame arrives, and then reused for every following frame
+class FrameRing():
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.frames = None # Allocated on the first frame
+        self.index = 0 # Slot which will be written next
+        self.count = 0 # Number of valid frames in the buffer
+
+    # Allocate the buffer for frames of a given shape
+    def allocate(self, frame_shape, dtype=np.uint8):
+        self.frames = np.empty((self.capacity, *frame_shape), dtype=dtype)
+        self.index = 0
+        self.count = 0
+
+    # Size of the buffer in bytes (0 if it is not allocated yet)
+    def nbytes(self):
+        return 0 if self.frames is None else self.frames.nbytes
+
+    # Returns the slot that the next frame should be decoded into, or None if the buffer isn't allocated
+    def next_slot(self):
+        if self.frames is None:
+            return None
+        return self.frames[self.index]
+
+    # Mark the slot returned by next_slot() as filled
+    def commit(self):
+        self.index = (self.index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    # Copy a frame into the next slot. Reallocates the buffer if the frame has a different shape
+    def push(self, frame):
+        if self.frames is None or self.frames.shape[1:] != frame.shape:
+            self.allocate(frame.shape, frame.dtype)
+        np.copyto(self.frames[self.index], frame)
+        self.commit()
+
+    # Returns a view of the n-th most recent frame (0 is the newest)
+    def latest(self, n=0):
+        assert n < self.count, "Not enough frames in the buffer"
+        return self.frames[(self.index - 1 - n) % self.capacity]
+
+    # Returns the n most recent frames, oldest first, as a single (n, H, W, C) copy
+    def snapshot(self, n):
+        n = min(n, self.count)
+        indices = np.arange(self.index - n, self.index) % self.capacity
+        return self.frames[indices]
+
+    # Forget all frames, but keep the allocated memory
+    def clear(self):
+        self.index = 0
+        self.count = 0
+
+
+# Keeps reading a cv.VideoCapture in its own thread and publishes only the newest frame
+# so OpenCV's internal buffer never fills with stale frames, however slow the consumer is
+# For replaying files: fps paces grabbing to the recorded speed, lossless makes the grabber wait until
+# the consumer took the previous frame and reconnect=False stops the grabber at the end of the file
+# Reconnects wait reconnect_delay seconds, twice as long after every reconnect which brings no frames,
+# up to max_reconnect_delay, so an unavailable camera isn't reopened in a busy loop
+class FrameGrabber():
+    def __init__(self, url, max_failed=3, log=print, open_capture=cv.VideoCapture, fps=None, lossless=False, reconnect=True,
+                 reconnect_delay=1, max_reconnect_delay=60):
+        self.url = url
+        self.max_failed = max_failed # Reconnect after this many frames in a row fail to load
+        self.reconnect_delay = reconnect_delay # Seconds
+        self.max_reconnect_delay = max_reconnect_delay
+        self.log = log
+        self.open_capture = open_capture # Called with url, returns an object with grab, retrieve and release
+        self.fps = fps
+        self.lossless = lossless
+        self.reconnect = reconnect
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.finished = False # Set when the grabber thread has nothing more to publish
+        self.thread = None
+
+        self.front = None # Newest published frame
+        self.back = None # Frame being decoded
+        self.seq = 0 # Sequence number of the newest frame, starts from 1
+        self.timestamp = 0 # time.time() when the newest frame was grabbed
+        self.consumed_seq = 0 # Sequence number of the last frame returned by read()
+        self.reconnects = 0
+
+    def start(self):
+        self.stopped.clear()
+        self.finished = False
+        self.thread = threading.Thread(target=self.grab_loop, daemon=True, name='frame-grabber')
+        self.thread.start()
+
+    # Stop grabbing and release the camera
+    def stop(self):
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    # Main loop of the grabber thread
+    def grab_loop(self):
+        self.log(f"Connecting to camera at {self.url}")
+        cam = self.open_capture(self.url)
+        self.log("Finished connecting")
+        failed = 0
+        delay = self.reconnect_delay
+        next_grab = time.perf_counter()
+        while not self.stopped.is_set():
+            # Replay at the recorded speed
+            if self.fps:
+                time.sleep(max(0, next_grab - time.perf_counter()))
+                next_grab += 1 / self.fps
+
+            try:
+                success = cam.grab()
+                grab_time = time.time()
+                if success:
+                    success, frame = cam.retrieve(self.back)
+            except cv.error:
+                success = False
+
+            if not success and not self.reconnect:
+                self.log("No more frames, stopping")
+                break
+
+            if not success:
+                failed += 1
+                if failed == 1 and delay == self.reconnect_delay: # Only after the camera worked
+                    self.log("Failed to read new frame")
+                # Restart the camera if many frames couldn't be loaded
+                if failed > self.max_failed:
+                    cam.release()
+                    self.log(f"Reconnecting to camera in {delay:g} s")
+                    if self.stopped.wait(delay):
+                        break
+                    delay = min(delay * 2, self.max_reconnect_delay) # Until a frame is read again
+                    cam = self.open_capture(self.url)
+                    self.reconnects += 1
+                    metricutils.metrics.count('reconnects')
+                    self.log("Reconnected" if getattr(cam, 'isOpened', lambda: True)() else "Failed to reconnect")
+                    failed = 0
+                continue
+
+            failed = 0
+            delay = self.reconnect_delay
+            # Publish the decoded frame and decode the next one into the previous front buffer
+            with self.condition:
+                if self.lossless:
+                    # Don't overwrite a frame the consumer hasn't seen
+                    self.condition.wait_for(lambda: self.consumed_seq == self.seq or self.stopped.is_set())
+                self.back, self.front = self.front, frame
+                self.seq += 1
+                self.timestamp = grab_time
+                self.condition.notify_all()
+            metricutils.metrics.count('frames grabbed')
+        cam.release()
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all() # Wake up the consumer waiting for a frame which won't come
+
+    # Wait for a frame newer than the one with sequence number after_seq and copy it into out
+    # Returns (success, frame, seq, timestamp). frame is out unless out is None or has a different shape
+    def read(self, out=None, after_seq=0, timeout=5):
+        with self.condition:
+            if self.lossless:
+                after_seq = min(after_seq, self.consumed_seq) # Skipping frames makes no sense without dropping
+            if not self.condition.wait_for(lambda: self.seq > after_seq or self.finished or self.stopped.is_set(), timeout):
+                return False, None, self.seq, self.timestamp
+            if self.seq <= after_seq:
+                return False, None, self.seq, self.timestamp
+
+            if out is not None and out.shape == self.front.shape:
+                np.copyto(out, self.front)
+            else:
+                out = self.front.copy()
+            self.consumed_seq = self.seq
+            self.condition.notify_all()
+            return True, out, self.seq, self.timestamp
@@ -0,0 +1,200 @@
+import collections
+import contextlib
+import cProfile
+import http.server
+import json
+import os
+import threading
+import time
+import numpy as np
+
+# Distribution of recent values of a measurement
+# Keeps the total count and sum and a window of the latest values for percentiles, so memory is bounded
+class Histogram():
+    def __init__(self, window=2048):
+        self.values = collections.deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.values.append(value)
+        self.count += 1
+        self.total += value
+
+    def summary(self):
+        if self.count == 0:
+            return {'count': 0}
+        values = np.array(self.values)
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        return {'count': self.count,
+                'sum': self.total,
+                'mean': self.total / self.count,
+                'p50': float(p50),
+                'p90': float(p90),
+                'p99': float(p99),
+                'max': float(values.max())}
+
+
+# Thread-safe registry of counters and histograms of the whole program
+class Metrics():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    # Add n to a counter
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    # Set a counter to a value, for numbers which are tracked elsewhere
+    def set(self, name, value):
+        with self.lock:
+            self.counters[name] = value
+
+    # Add a value to a histogram
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+
+    # Measure seconds spent inside a with block
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    # Forget all measurements
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    # Returns all measurements as a dictionary
+    def snapshot(self):
+        with self.lock:
+            return {'pid': os.getpid(), # For attaching py-spy
+                    'uptime': time.time() - self.started,
+                    'counters': dict(self.counters),
+                    'histograms': {name: histogram.summary() for name, histogram in self.histograms.items()}}
+
+    # Returns all measurements in Prometheus text format
+    def render_text(self):
+        snapshot = self.snapshot()
+        clean = lambda name: 'foxspy_' + ''.join(c if c.isalnum() else '_' for c in name.lower())
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f"{clean(name)} {value}")
+        for name, summary in sorted(snapshot['histograms'].items()):
+            for key in ('p50', 'p90', 'p99'):
+                if key in summary:
+                    lines.append(f'{clean(name)}{{quantile="0.{key[1:]}"}} {summary[key]}')
+            lines.append(f"{clean(name)}_count {summary['count']}")
+            lines.append(f"{clean(name)}_sum {summary.get('sum', 0)}")
+        return '\n'.join(lines) + '\n'
+
+
+# cProfile only sees the thread it was enabled in, so every instrumented loop calls check() regularly
+# and the profiler is switched on or off in that thread. Profiles are dumped to profile-<thread name>.prof
+class Profiler():
+    def __init__(self, folder='.'):
+        self.folder = folder
+        self.requested = False
+        self.local = threading.local()
+
+    def start(self):
+        self.requested = True
+
+    def stop(self):
+        self.requested = False
+
+    def toggle(self):
+        self.requested = not self.requested
+
+    # Start or stop profiling the calling thread to match the requested state
+    def check(self):
+        profile = getattr(self.local, 'profile', None)
+        if self.requested and profile is None:
+            self.local.profile = cProfile.Profile()
+            self.local.profile.enable()
+        elif not self.requested and profile is not None:
+            profile.disable()
+            name = threading.current_thread().name
+            profile.dump_stats(os.path.join(self.folder, f"profile-{name}.prof"))
+            self.local.profile = None
+
+
+# Rewrites a json file with a metrics snapshot every few seconds
+class StatsFileWriter():
+    def __init__(self, metrics: Metrics, path, interval=10):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.write_loop, daemon=True, name='stats-writer')
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def write(self):
+        # Write a temporary file and replace the old one, so readers never see half a file
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump(self.metrics.snapshot(), file, indent=4)
+        os.replace(self.path + '.tmp', self.path)
+
+    def write_loop(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+        self.write()
+
+
+# Serves metrics over HTTP on localhost:
+# /metrics - text format, /stats - json, /profile/start and /profile/stop - switch the profiler
+class MetricsServer():
+    def __init__(self, metrics: Metrics, profiler: Profiler, port):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path == '/metrics':
+                    body, content_type = metrics.render_text(), 'text/plain; version=0.0.4'
+                elif handler.path == '/stats':
+                    body, content_type = json.dumps(metrics.snapshot(), indent=4), 'application/json'
+                elif handler.path in ('/profile/start', '/profile/stop'):
+                    profiler.start() if handler.path.endswith('start') else profiler.stop()
+                    body, content_type = f"Profiling: {profiler.requested}\n", 'text/plain'
+                else:
+                    handler.send_error(404)
+                    return
+                data = body.encode()
+                handler.send_response(200)
+                handler.send_header('Content-Type', content_type)
+                handler.send_header('Content-Length', str(len(data)))
+                handler.end_headers()
+                handler.wfile.write(data)
+
+            def log_message(handler, format, *args):
+                pass # Don't print every request
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True, name='metrics-server')
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Registry and profiler shared by the whole program
+metrics = Metrics()
+profiler = Profiler()
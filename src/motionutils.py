@@ -0,0 +1,161 @@
+import cv2 as cv
+import numpy as np
+
+# Detects movement between consequent frames
+# Frames are shrunk (and optionally converted to grayscale) once, then compared with the previous reduced frame.
+# All buffers are allocated on the first frame and reused afterwards, so update() does not allocate new arrays
+class MotionDetector():
+    def __init__(self, downscale=4, grayscale=True, mask=None, pixel_threshold=25):
+        self.downscale = downscale # Frames are shrunk by this factor in each dimension
+        self.grayscale = grayscale
+        self.pixel_threshold = pixel_threshold # Pixels which changed more than this are counted in bounding_box()
+        self.full_mask = mask # Optional ROI mask of the full frame size, non-zero pixels are watched
+        self.frame_shape = None
+
+    # Allocate buffers for frames of a given shape
+    def allocate(self, frame_shape):
+        self.frame_shape = frame_shape
+        height, width = frame_shape[:2]
+        self.size = (max(1, width // self.downscale), max(1, height // self.downscale)) # (width, height) as OpenCV expects
+        channels = 1 if self.grayscale else frame_shape[2]
+
+        self.small = np.empty((self.size[1], self.size[0], frame_shape[2]), dtype=np.uint8) # Shrunk colour frame
+        reduced_shape = (self.size[1], self.size[0]) if self.grayscale else self.small.shape
+        self.reduced = [np.empty(reduced_shape, dtype=np.uint8) for _ in range(2)] # Current and previous frames
+        self.diff = np.empty(reduced_shape, dtype=np.uint8)
+        self.changed = np.empty((self.size[1], self.size[0]), dtype=np.uint8) # Binary mask of changed pixels
+        self.kernel = np.ones((3, 3), dtype=np.uint8)
+        self.current = 0 # Index of the most recent frame in self.reduced
+        self.has_previous = False
+
+        # Scale the ROI mask down to the size of reduced frames
+        if self.full_mask is not None:
+            self.mask = cv.resize(self.full_mask.astype(np.uint8), self.size, interpolation=cv.INTER_NEAREST)
+            self.n_values = max(1, cv.countNonZero(self.mask)) * channels
+        else:
+            self.mask = None
+            self.n_values = self.size[0] * self.size[1] * channels
+
+    # Forget the previous frame, so the next update() starts a new sequence
+    def reset(self):
+        self.has_previous = False
+
+    # Shrink a frame into a preallocated buffer
+    # INTER_LINEAR only reads a few pixels around each output pixel, INTER_AREA averages all of them
+    # and costs about as much as the rest of update() several times over
+    def reduce(self, frame, out):
+        if self.grayscale:
+            cv.resize(frame, self.size, dst=self.small, interpolation=cv.INTER_LINEAR)
+            cv.cvtColor(self.small, cv.COLOR_BGR2GRAY, dst=out)
+        else:
+            cv.resize(frame, self.size, dst=out, interpolation=cv.INTER_LINEAR)
+        return out
+
+    # Mean squared difference between two reduced frames
+    def reduced_mse(self, reduced1, reduced2):
+        cv.absdiff(reduced1, reduced2, dst=self.diff) # uint8 absolute difference can't overflow
+        return cv.norm(self.diff, cv.NORM_L2SQR, mask=self.mask) / self.n_values
+
+    # Add a new frame and return its MSE with the previous one (0 for the first frame)
+    def update(self, frame):
+        if self.frame_shape != frame.shape:
+            self.allocate(frame.shape)
+
+        previous = self.current
+        self.current = 1 - self.current
+        self.reduce(frame, self.reduced[self.current])
+
+        if not self.has_previous:
+            self.has_previous = True
+            return 0
+        return self.reduced_mse(self.reduced[self.current], self.reduced[previous])
+
+
+    # Bounding box (x, y, width, height) of pixels which changed between the two last frames,
+    # in coordinates of the full frame. None if nothing changed
+    def bounding_box(self):
+        if not self.has_previous:
+            return None
+        diff = self.diff if self.grayscale else cv.cvtColor(self.diff, cv.COLOR_BGR2GRAY)
+        cv.threshold(diff, self.pixel_threshold, 255, cv.THRESH_BINARY, dst=self.changed)
+        if self.mask is not None:
+            cv.bitwise_and(self.changed, self.mask, dst=self.changed)
+        cv.erode(self.changed, self.kernel, dst=self.changed) # Remove single noisy pixels
+        x, y, width, height = cv.boundingRect(self.changed)
+        if width == 0 or height == 0:
+            return None
+
+        # Scale back to the full frame
+        scale_x = self.frame_shape[1] / self.size[0]
+        scale_y = self.frame_shape[0] / self.size[1]
+        return (int(x * scale_x), int(y * scale_y), int(np.ceil(width * scale_x)), int(np.ceil(height * scale_y)))
+
+
+# Returns the smallest box containing both boxes. Either box can be None
+def merge_boxes(box1, box2):
+    if box1 is None:
+        return box2
+    if box2 is None:
+        return box1
+    x = min(box1[0], box2[0])
+    y = min(box1[1], box2[1])
+    right = max(box1[0] + box1[2], box2[0] + box2[2])
+    bottom = max(box1[1] + box1[3], box2[1] + box2[3])
+    return (x, y, right - x, bottom - y)
+
+# Grows a box by padding on each side and to a square (the CNN takes square images), keeping it inside the frame
+# Returns None if the result would cover most of the frame anyway
+def pad_box(box, frame_shape, padding=0.25, min_size=96, max_fraction=0.8):
+    if box is None:
+        return None
+    frame_height, frame_width = frame_shape[:2]
+    x, y, width, height = box
+    size = max(width, height, min_size)
+    size = int(size * (1 + 2 * padding))
+    size = min(size, frame_width, frame_height)
+    if size < max(width, height): # The square can't contain the whole box
+        return None
+
+    # Centre the square on the box and move it inside the frame
+    left = min(max(0, x + width // 2 - size // 2), frame_width - size)
+    top = min(max(0, y + height // 2 - size // 2), frame_height - size)
+    if size * size > max_fraction * frame_width * frame_height:
+        return None
+    return (left, top, size, size)
+
+
+# Tracks the recent distribution of frame MSE to tell real movement from noise (IR noise, rain, headlights)
+# The distribution is a histogram over log-spaced bins which slowly forgets old values,
+# so memory is fixed and the threshold follows changes of the scene
+class NoiseEstimator():
+    def __init__(self, quantile=0.95, multiplier=2.0, half_life=8400, warm_up=100, n_bins=64, min_mse=0.01, max_mse=10000):
+        self.quantile = quantile # Quantile of the noise distribution used as the noise level
+        self.multiplier = multiplier # Movement has to exceed the noise level this many times
+        self.decay = 0.5 ** (1 / half_life) # half_life is in frames, 8400 is 10 minutes at 14 fps
+        self.warm_up = warm_up # Number of frames before the estimate is used
+        self.edges = np.logspace(np.log10(min_mse), np.log10(max_mse), n_bins + 1)
+        self.counts = np.zeros(n_bins + 2) # Extra bins for values below and above the edges
+        self.n_updates = 0
+
+    # Add an MSE of a new frame
+    def update(self, mse):
+        self.counts *= self.decay
+        self.counts[np.searchsorted(self.edges, mse)] += 1
+        self.n_updates += 1
+
+    # Estimate of a quantile of recent MSE values (upper edge of the bin containing it)
+    def estimate(self, quantile):
+        cumulative = np.cumsum(self.counts)
+        index = int(np.searchsorted(cumulative, quantile * cumulative[-1]))
+        return self.edges[min(index, len(self.edges) - 1)]
+
+    # Threshold above which a frame counts as movement. Never lower than min_threshold
+    def threshold(self, min_threshold):
+        if self.n_updates < self.warm_up:
+            return min_threshold
+        return max(min_threshold, self.estimate(self.quantile) * self.multiplier)
+
+    def stats(self):
+        return {'frames': self.n_updates,
+                'median': float(self.estimate(0.5)),
+                'noise level': float(self.estimate(self.quantile))}
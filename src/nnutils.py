@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import argparse
+import cv2 as cv
+import numpy as np
+from src import benchutils
+
+EXPORT_PATH = './NN.ts' # Default path of an exported model. Metadata is saved next to it as <path>.json
+FORMATS = ('torchscript', 'onnx')
+QUANTIZATIONS = (None, 'dynamic', 'static')
+
+# Returns preprocessing parameters the learner applies at inference time:
+# input size, resize method and normalization statistics
+def get_preprocessing(learner):
+    size = None
+    method = 'crop'
+    for tfm in learner.dls.after_item.fs:
+        if type(tfm).__name__ in ('Resize', 'RandomResizedCrop'):
+            width, height = tfm.size # fastai stores size as (width, height)
+            size = (int(height), int(width))
+            method = str(getattr(tfm, 'method', 'crop')) # RandomResizedCrop takes the centre at inference
+    assert size is not None, "Learner has no Resize transform, the input size is unknown"
+
+    mean, std = [0.0, 0.0, 0.0], [1.0, 1.0, 1.0]
+    for tfm in learner.dls.after_batch.fs:
+        if type(tfm).__name__ == 'Normalize':
+            mean = tfm.mean.flatten().tolist()
+            std = tfm.std.flatten().tolist()
+
+    return {'size': size, 'method': method, 'mean': mean, 'std': std}
+
+
+# Converts RGB images to a normalized float32 NCHW batch the same way the learner would
+def preprocess(images, size, method, mean, std):
+    height, width = size
+    batch = np.empty((len(images), 3, height, width), dtype=np.float32)
+    for i, img in enumerate(images):
+        if method == 'crop':
+            # Cut the centre to the target aspect ratio before resizing
+            img_height, img_width = img.shape[:2]
+            scale = min(img_height / height, img_width / width)
+            crop_height, crop_width = int(round(height * scale)), int(round(width * scale))
+            top, left = (img_height - crop_height) // 2, (img_width - crop_width) // 2
+            img = img[top : top + crop_height, left : left + crop_width]
+        img = cv.resize(img, (width, height), interpolation=cv.INTER_LINEAR)
+        batch[i] = img.transpose(2, 0, 1)
+
+    batch /= 255
+    batch -= np.array(mean, dtype=np.float32).reshape(1, 3, 1, 1)
+    batch /= np.array(std, dtype=np.float32).reshape(1, 3, 1, 1)
+    return batch
+
+
+# Exports the learner's model to TorchScript or ONNX, optionally quantized to int8
+# Static quantization needs a few RGB calibration images
+def export(learner, path=EXPORT_PATH, format='torchscript', quantize=None, calibration_images=None):
+    import torch # Only exporting and TorchScript models need it, an ONNX model runs without it
+    assert format in FORMATS, f"Unknown format: {format}"
+    assert quantize in QUANTIZATIONS, f"Unknown quantization: {quantize}"
+    params = get_preprocessing(learner)
+    model = learner.model.eval().cpu()
+    example = torch.zeros(1, 3, *params['size'])
+
+    if quantize == 'dynamic' and format == 'torchscript':
+        # Only linear layers are quantized, convolutions stay in float
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif quantize == 'static':
+        assert format == 'torchscript', "Static quantization is only supported for TorchScript"
+        assert calibration_images, "Static quantization needs calibration images"
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+        prepared = prepare_fx(model, get_default_qconfig_mapping('x86'), (example,))
+        with torch.no_grad():
+            for i in range(0, len(calibration_images), 16):
+                prepared(torch.from_numpy(preprocess(calibration_images[i : i + 16], **params)))
+        model = convert_fx(prepared)
+
+    with torch.no_grad():
+        if format == 'torchscript':
+            traced = torch.jit.freeze(torch.jit.trace(model, example))
+            traced.save(path)
+        else:
+            torch.onnx.export(model, example, path, input_names=['input'], output_names=['logits'],
+                              dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}})
+            if quantize == 'dynamic':
+                from onnxruntime.quantization import quantize_dynamic, QuantType
+                quantize_dynamic(path, path, weight_type=QuantType.QInt8)
+
+    metadata = {'format': format, 'quantize': quantize, 'vocab': list(learner.dls.vocab), **params}
+    with open(path + '.json', 'w') as file:
+        json.dump(metadata, file, indent=4)
+    return metadata
+
+
+# Runs an exported model without fastai
+class ExportedModel():
+    def __init__(self, path=EXPORT_PATH, n_threads=None):
+        with open(path + '.json', 'r') as file:
+            self.metadata = json.load(file)
+        self.vocab = self.metadata['vocab']
+        self.format = self.metadata['format']
+        self.params = {key: self.metadata[key] for key in ('size', 'method', 'mean', 'std')}
+
+        if self.format == 'torchscript':
+            import torch
+            if n_threads:
+                torch.set_num_threads(n_threads)
+            self.model = torch.jit.load(path, map_location='cpu').eval()
+        else:
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            if n_threads:
+                options.intra_op_num_threads = n_threads
+            self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    # Returns a (number of images, number of labels) array of class probabilities for RGB images
+    def predict_probs(self, images, batch_size=16):
+        probs = []
+        for i in range(0, len(images), batch_size):
+            batch = preprocess(images[i : i + batch_size], **self.params)
+            if self.format == 'torchscript':
+                import torch
+                with torch.no_grad():
+                    logits = self.model(torch.from_numpy(batch)).numpy()
+            else:
+                logits = self.session.run(None, {'input': batch})[0]
+            # Softmax, the same activation fastai applies to the model's output
+            logits = logits - logits.max(axis=1, keepdims=True)
+            exp = np.exp(logits)
+            probs.append(exp / exp.sum(axis=1, keepdims=True))
+
+        if len(probs) == 0:
+            return np.zeros((0, len(self.vocab)), dtype=np.float32)
+        return np.concatenate(probs)
+
+
+# Reads all frames of a video file
+def read_video(path):
+    video = cv.VideoCapture(path)
+    frames = []
+    success, frame = video.read()
+    while success:
+        frames.append(frame)
+        success, frame = video.read()
+    video.release()
+    return frames
+
+# Compares predictions of the original learner and an exported model on videos
+def check_parity(classifier, exported: ExportedModel, video_paths):
+    classifier.load()
+    assert list(classifier.vocab) == exported.vocab, "Label sets do not match"
+    report = {'videos': {}, 'frames': 0, 'frames agree': 0, 'clips agree': 0, 'max probability difference': 0.0,
+              'original ms per frame': 0.0, 'exported ms per frame': 0.0}
+    original_time = exported_time = 0
+
+    for path in video_paths:
+        video = read_video(path)
+        images = classifier.select_frames(video)
+
+        start = time.perf_counter()
+        original = classifier.predict_probs(images)
+        original_time += time.perf_counter() - start
+        start = time.perf_counter()
+        probs = exported.predict_probs(images, classifier.batch_size)
+        exported_time += time.perf_counter() - start
+
+        original_label = classifier.vote(original, len(video))
+        exported_label = classifier.vote(probs, len(video))
+        report['videos'][path] = {'original': original_label, 'exported': exported_label, 'frames': len(images)}
+        report['frames'] += len(images)
+        report['frames agree'] += int(np.sum(np.argmax(original, axis=1) == np.argmax(probs, axis=1)))
+        report['clips agree'] += original_label == exported_label
+        if len(images) > 0:
+            report['max probability difference'] = max(report['max probability difference'],
+                                                       float(np.abs(original - probs).max()))
+
+    if report['frames'] > 0:
+        report['original ms per frame'] = original_time * 1000 / report['frames']
+        report['exported ms per frame'] = exported_time * 1000 / report['frames']
+    report['peak memory MiB'] = benchutils.peak_memory()
+    return report
+
+
+# Export the learner and check that the exported model gives the same labels
+# Run from the project folder: python -m src.nnutils --format onnx --quantize dynamic
+if __name__ == "__main__":
+    from src import camutils
+    parser = argparse.ArgumentParser(description='Export NN.pkl to a lighter runtime')
+    parser.add_argument('--path', default=EXPORT_PATH)
+    parser.add_argument('--format', choices=FORMATS, default='torchscript')
+    parser.add_argument('--quantize', choices=['dynamic', 'static'], default=None)
+    parser.add_argument('--videos', default='./videos/', help='Folder with videos used for calibration and parity check')
+    args = parser.parse_args()
+
+    classifier = camutils.Classifier()
+    classifier.load()
+    video_paths = [os.path.join(args.videos, file) for file in sorted(os.listdir(args.videos)) if file.endswith('.mp4')]
+
+    calibration_images = None
+    if args.quantize == 'static':
+        calibration_images = []
+        for path in video_paths:
+            calibration_images += classifier.select_frames(read_video(path))
+
+    print(export(classifier.learner, args.path, args.format, args.quantize, calibration_images))
+    report = check_parity(classifier, ExportedModel(args.path), video_paths)
+    print(json.dumps(report, indent=4))
@@ -0,0 +1,152 @@
+import collections
+import threading
+import time
+from src import metricutils
+
+# What to do with a new clip when the queue is full
+DROP_OLDEST = 'drop oldest' # Throw away the clip that has been waiting the longest
+DROP_NEWEST = 'drop newest' # Throw away the new clip
+BLOCK = 'block' # Wait until a worker takes a clip (stalls the caller)
+POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+# A bounded thread-safe queue of recorded clips waiting to be processed
+# The queue is full when it has max_size clips or, if max_bytes is given, when the next clip would make the waiting
+# clips larger than max_bytes. A clip is always accepted into an empty queue, however large it is
+class ClipQueue():
+    def __init__(self, max_size=4, policy=DROP_OLDEST, on_drop=None, max_bytes=None, size=None):
+        assert policy in POLICIES, f"Unknown backpressure policy: {policy}"
+        assert max_bytes is None or size is not None, "Sizes of clips are needed to limit the queue in bytes"
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.size = size # Returns the size of a clip in bytes
+        self.policy = policy
+        self.on_drop = on_drop # Called with every clip that is dropped
+        self.clips = collections.deque() # (clip, size, time when it was queued)
+        self.bytes = 0 # Total size of waiting clips
+        self.condition = threading.Condition()
+        self.closed = False
+
+        # Counters
+        self.queued = 0 # Clips accepted into the queue in total
+        self.in_flight = 0 # Clips currently processed by workers
+        self.dropped = 0 # Clips thrown away because the queue was full
+
+    # Whether a clip of a given size has to wait or be dropped
+    def full(self, size):
+        if len(self.clips) >= self.max_size:
+            return True
+        return self.max_bytes is not None and len(self.clips) > 0 and self.bytes + size > self.max_bytes
+
+    # Add a clip to the queue. Returns False if the clip was dropped
+    def put(self, clip):
+        dropped_clips = []
+        accepted = True
+        size = self.size(clip) if self.size else 0
+        with self.condition:
+            if self.closed:
+                return False
+
+            if self.full(size):
+                if self.policy == DROP_NEWEST:
+                    dropped_clips.append(clip)
+                    accepted = False
+                elif self.policy == DROP_OLDEST:
+                    while self.full(size):
+                        oldest, oldest_size, _ = self.clips.popleft()
+                        self.bytes -= oldest_size
+                        dropped_clips.append(oldest)
+                else:
+                    while self.full(size) and not self.closed:
+                        self.condition.wait()
+                    if self.closed:
+                        return False
+            self.dropped += len(dropped_clips)
+
+            if accepted:
+                self.clips.append((clip, size, time.perf_counter())) # Remember when the clip was queued
+                self.bytes += size
+                self.queued += 1
+                self.condition.notify_all()
+            metricutils.metrics.set('clips waiting', len(self.clips))
+            metricutils.metrics.set('clip bytes waiting', self.bytes)
+
+        # Call the callback outside of the lock so it can't stall the workers
+        for dropped_clip in dropped_clips:
+            metricutils.metrics.count('clips dropped')
+            if self.on_drop:
+                self.on_drop(dropped_clip)
+        return accepted
+
+    # Take a clip from the queue, waiting for one if needed. Returns None when the queue is closed and empty
+    def get(self):
+        with self.condition:
+            while len(self.clips) == 0 and not self.closed:
+                self.condition.wait()
+            if len(self.clips) == 0:
+                return None
+            self.in_flight += 1
+            clip, size, queued_time = self.clips.popleft()
+            self.bytes -= size
+            metricutils.metrics.observe('queue wait', time.perf_counter() - queued_time)
+            metricutils.metrics.set('clips waiting', len(self.clips))
+            metricutils.metrics.set('clip bytes waiting', self.bytes)
+            self.condition.notify_all()
+            return clip
+
+    # Must be called by a worker after it finished processing a clip returned by get()
+    def task_done(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    # Stop accepting new clips. Workers finish the clips that are already queued
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    # Returns a dictionary with the current state of the queue
+    def stats(self):
+        with self.condition:
+            return {'waiting': len(self.clips),
+                    'bytes waiting': self.bytes,
+                    'queued': self.queued,
+                    'in flight': self.in_flight,
+                    'dropped': self.dropped}
+
+
+# A pool of threads which take clips from a ClipQueue and pass them to a handler
+class ClipWorkers():
+    def __init__(self, queue: ClipQueue, handler, n_workers=1, on_error=None):
+        self.queue = queue
+        self.handler = handler
+        self.on_error = on_error # Called with the exception if handler fails
+        self.threads = [threading.Thread(target=self.work, daemon=True, name=f'clip-worker-{i}')
+                        for i in range(n_workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    # Main loop of a worker thread
+    def work(self):
+        while True:
+            clip = self.queue.get()
+            if clip is None:
+                return
+            metricutils.profiler.check()
+            try:
+                self.handler(clip)
+            except Exception as e:
+                # Keep the worker alive, one broken clip shouldn't stop the recording
+                if self.on_error:
+                    self.on_error(e)
+            finally:
+                self.queue.task_done()
+
+    # Close the queue and wait for the workers to finish queued clips
+    def stop(self):
+        self.queue.close()
+        for thread in self.threads:
+            if thread.is_alive():
+                thread.join()
@@ -0,0 +1,174 @@
+import os
+import json
+import argparse
+import concurrent.futures
+from src import dbutils
+
+PROGRESS_PATH = './reclassify_progress.jsonl'
+SAVED_LABELS = ('Cat', 'Fox') # Only these clips are kept, same as in Camera.process_frames
+
+# Classifier of a worker process, loaded once by init_worker
+classifier = None
+
+# Runs in every worker process before it takes any videos
+def init_worker(model_path, n_threads):
+    global classifier
+    import torch
+    from src import camutils
+    torch.set_num_threads(n_threads) # Processes already use all cores, more threads would only compete
+    classifier = camutils.Classifier(model_path=model_path)
+    classifier.load()
+
+# Decodes and classifies one video in a worker process. Returns the file name and the new label
+def classify_file(path, crop):
+    from src import nnutils
+    frames = nnutils.read_video(path)
+    label = classifier.classify_clip(frames, crop)['label'] if len(frames) > 0 else None
+    return os.path.basename(path), label
+
+# Labels found by an earlier run that was interrupted, {file name: label}
+def read_progress(path):
+    progress = {}
+    if os.path.exists(path):
+        with open(path) as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # The line was being written when the run stopped
+                progress[entry['file']] = entry['label']
+    return progress
+
+# Classifies all saved videos in a folder with a pool of processes
+# Every result is appended to the progress file right away, so an interrupted run continues where it stopped
+# Returns {file name: new label}
+def classify_archive(folder, model_path=None, n_workers=None, n_threads=1, crop=None, progress_path=PROGRESS_PATH,
+                     log=print):
+    from src import camutils
+    crop = crop or camutils.DEFAULT_CROP
+    files = sorted(file for file in os.listdir(folder) if dbutils.parse_video_name(file) is not None)
+    labels = read_progress(progress_path)
+    remaining = [os.path.join(folder, file) for file in files if file not in labels]
+    log(f"{len(files)} videos, {len(files) - len(remaining)} already classified")
+
+    n_workers = n_workers or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(n_workers, initializer=init_worker,
+                                                initargs=(model_path, n_threads)) as executor, \
+         open(progress_path, 'a') as progress:
+        # Videos are sent in chunks to spend less time passing messages between processes
+        results = executor.map(classify_file, remaining, [crop] * len(remaining), chunksize=4)
+        for i, (file, label) in enumerate(results, 1):
+            labels[file] = label
+            progress.write(json.dumps({'file': file, 'label': label}) + '\n')
+            progress.flush()
+            if i % 100 == 0:
+                log(f"Classified {i} of {len(remaining)} videos")
+    return {file: labels[file] for file in files if file in labels}
+
+# Compares new labels with the current ones
+# Returns a list of (file name, old label, new label), where new label is None if the clip should be removed
+def diff_labels(labels, remove=False):
+    changes = []
+    for file, new_label in sorted(labels.items()):
+        old_label, _ = dbutils.parse_video_name(file)
+        if new_label not in SAVED_LABELS:
+            # Clips which wouldn't have been saved are removed only if asked to, the old model could be right
+            if not remove or new_label is None:
+                continue
+            new_label = None
+        if new_label != old_label:
+            changes.append((file, old_label, new_label))
+    return changes
+
+# Returns a readable report of changes
+def format_diff(changes, n_videos):
+    lines = [f"{file}: {old_label} -> {new_label or 'Remove'}" for file, old_label, new_label in changes]
+    counts = {}
+    for _, old_label, new_label in changes:
+        key = f"{old_label} -> {new_label or 'Remove'}"
+        counts[key] = counts.get(key, 0) + 1
+    lines.append(f"{len(changes)} of {n_videos} videos change: {counts}")
+    return '\n'.join(lines)
+
+# Renames the videos and updates the database together
+# If the database can't be updated, the videos get their old names back. Removed videos are moved aside
+# until the database is updated, so they can be restored too
+# A video whose new name is already taken (e.g. two clips saved in the same second) is skipped and reported
+# Returns (number of changed records or None if the database didn't count them, list of skipped changes)
+def apply_changes(db, changes, folder, log=print):
+    moved = [] # (old path, new path)
+    applied = [] # Changes whose videos were renamed
+    skipped = []
+    try:
+        for change in changes:
+            file, old_label, new_label = change
+            old_path = os.path.join(folder, file)
+            if new_label is None:
+                new_path = os.path.join(folder, dbutils.RECORDING_PREFIX + file) # Hidden from the video player
+            else:
+                new_path = os.path.join(folder, new_label + file[len(old_label):])
+            if os.path.exists(new_path):
+                log(f"Skipping {file}: {os.path.basename(new_path)} already exists")
+                skipped.append(change)
+                continue
+            os.replace(old_path, new_path)
+            moved.append((old_path, new_path))
+            applied.append(change)
+        n_changed = db.change_labels({dbutils.parse_video_name(file)[1]: new_label
+                                      for file, _, new_label in applied})
+    except:
+        for old_path, new_path in reversed(moved):
+            os.replace(new_path, old_path)
+        raise
+
+    for (_, new_path), (_, _, new_label) in zip(moved, applied):
+        if new_label is None:
+            os.remove(new_path)
+    return n_changed, skipped
+
+
+# Camera crop (top,bottom,left,right) from text such as "100,10,0,50", the format of the setting
+def parse_crop(text):
+    return tuple(int(pixels) for pixels in text.split(','))
+
+# Camera crop and database backend the program uses, from settings.json if it exists
+def default_settings(path='settings.json'):
+    from src import camutils, settings
+    defaults = {'Camera crop': ','.join(str(pixels) for pixels in camutils.DEFAULT_CROP), 'Database backend': 'csv'}
+    if os.path.exists(path):
+        saved = settings.Settings(path).settings
+        defaults.update({name: saved[name] for name in defaults if name in saved})
+    return defaults
+
+
+# Run from the project folder after retraining NN.pkl: python -m src.reclassify --dry-run
+if __name__ == "__main__":
+    defaults = default_settings()
+    parser = argparse.ArgumentParser(description='Classify all saved videos again and update their labels')
+    parser.add_argument('--videos', default=dbutils.VIDEOS_PATH)
+    parser.add_argument('--model', default=None, help='Exported model to use instead of NN.pkl')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes, defaults to the number of cores')
+    parser.add_argument('--threads', type=int, default=1, help='Torch threads in every process')
+    parser.add_argument('--progress', default=PROGRESS_PATH, help='File which keeps results of an interrupted run')
+    parser.add_argument('--remove', action='store_true', help='Remove videos which are no longer a cat or a fox')
+    parser.add_argument('--backend', choices=dbutils.BACKENDS, default=defaults['Database backend'],
+                        help='Database backend, defaults to the one in settings.json')
+    parser.add_argument('--crop', type=parse_crop, default=parse_crop(defaults['Camera crop']),
+                        help='Pixels cut from the frames as top,bottom,left,right, defaults to the camera crop in settings.json')
+    parser.add_argument('--dry-run', action='store_true', help='Only print the changes')
+    args = parser.parse_args()
+
+    labels = classify_archive(args.videos, args.model, args.workers, args.threads, args.crop, args.progress)
+    changes = diff_labels(labels, args.remove)
+    print(format_diff(changes, len(labels)))
+    # After a dry run the progress file is kept, so applying the changes doesn't classify everything again
+    if not args.dry_run:
+        if len(changes) > 0:
+            db = dbutils.open_database(args.backend, log=True)
+            n_changed, skipped = apply_changes(db, changes, args.videos)
+            db.close()
+            records = f"changed {n_changed} records, " if n_changed is not None else ""
+            print(f"Renamed {len(changes) - len(skipped)} videos, {records}"
+                  f"skipped {len(skipped)} videos whose new name is taken")
+        if os.path.exists(args.progress):
+            os.remove(args.progress) # Done, the next run starts from scratch
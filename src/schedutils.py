@@ -0,0 +1,102 @@
+import datetime
+import re
+
+DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+# A window is "[days ]hh:mm-hh:mm", days are comma separated names or ranges. Spaces are allowed around ',' and '-'
+DAY_NAME = rf"(?i:{'|'.join(DAYS)})"
+DAY_PATTERN = rf'{DAY_NAME}(?: *- *{DAY_NAME})?'
+TIME_PATTERN = r'(?:[01]?\d|2[0-3]):[0-5]\d'
+WINDOW_PATTERN = rf' *(?:({DAY_PATTERN}(?: *, *{DAY_PATTERN})*) +)?({TIME_PATTERN}) *- *({TIME_PATTERN}) *'
+PATTERN = rf'(?:{WINDOW_PATTERN}(?:;{WINDOW_PATTERN})*;? *)?' # Whole schedule, for validating settings
+
+# Working hours of a camera: a list of daily time windows, each optionally limited to some weekdays
+# A window which ends earlier than it starts lasts past midnight and belongs to the day it starts.
+# A window which ends when it starts lasts the whole day
+class Schedule():
+    def __init__(self, windows):
+        self.windows = windows # List of (start: datetime.time, end: datetime.time, weekdays: set of 0-6 or None)
+
+    # Schedule with a single window every day, as set by "Camera start time" and "Camera end time"
+    @staticmethod
+    def from_times(start_time, end_time):
+        return Schedule([(start_time.time() if isinstance(start_time, datetime.datetime) else start_time,
+                          end_time.time() if isinstance(end_time, datetime.datetime) else end_time,
+                          None)])
+
+    # Parses windows separated by ';', each "[days ]hh:mm-hh:mm",
+    # where days are comma separated names or ranges, e.g. "23:00-6:00; Sat,Sun 12:00-14:00; Mon-Fri 7:00-8:00"
+    # Raises ValueError if the text isn't a valid schedule
+    @staticmethod
+    def parse(text):
+        windows = []
+        for window in text.split(';'):
+            if not window.strip():
+                continue
+            match = re.fullmatch(WINDOW_PATTERN, window)
+            if match is None:
+                raise ValueError(f"Invalid working window: {window.strip()}")
+            days_text, start_text, end_text = match.groups()
+            days = None
+            if days_text:
+                days = set()
+                for part in days_text.replace(' ', '').split(','):
+                    if '-' in part:
+                        first, last = (day_index(day) for day in part.split('-'))
+                        days.update(day % 7 for day in range(first, last + 1 if last >= first else last + 8))
+                    else:
+                        days.add(day_index(part))
+            start, end = (datetime.datetime.strptime(t, "%H:%M").time() for t in (start_text, end_text))
+            windows.append((start, end, days))
+        return Schedule(windows)
+
+    # Active intervals (start, end) overlapping the period around now, merged and sorted
+    def intervals(self, now, days_before=1, days_after=8):
+        intervals = []
+        for offset in range(-days_before, days_after + 1):
+            day = (now + datetime.timedelta(days=offset)).date()
+            for start, end, weekdays in self.windows:
+                if weekdays is not None and day.weekday() not in weekdays:
+                    continue
+                start_dt = datetime.datetime.combine(day, start)
+                end_dt = datetime.datetime.combine(day, end)
+                if end_dt <= start_dt:
+                    end_dt += datetime.timedelta(days=1)
+                intervals.append((start_dt, end_dt))
+
+        intervals.sort()
+        merged = []
+        for start, end in intervals:
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    # Returns (active, time of the next change): whether the camera should work now,
+    # and when it should be switched on or off next. The time is None if the schedule never changes
+    def next_change(self, now=None):
+        now = now or datetime.datetime.now()
+        week_later = now + datetime.timedelta(days=7)
+        for start, end in self.intervals(now):
+            if now < start:
+                return False, start
+            if now < end:
+                # Only windows covering every day merge into an interval longer than a week
+                return True, end if end <= week_later else None
+        return False, None
+
+    def is_active(self, now=None):
+        return self.next_change(now)[0]
+
+
+# Index of a day name in DAYS, in any case
+def day_index(name):
+    if name.capitalize() not in DAYS:
+        raise ValueError(f"Unknown day: {name}")
+    return DAYS.index(name.capitalize())
+
+# Real number of seconds from now until a local time, also when the clocks change in between (daylight saving time)
+def seconds_until(when, now=None):
+    now = now or datetime.datetime.now()
+    return (when.astimezone() - now.astimezone()).total_seconds()
@@ -0,0 +1,25 @@
+import subprocess
+import sys
+
+# Imports a module in a fresh interpreter with -X importtime
+# Returns a list of (package, seconds) pairs sorted by the time spent importing each top-level package
+def import_times(module='main'):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        # Lines look like "import time:       512 |       1024 |   package.module"
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        times[package] = times.get(package, 0) + int(self_us) / 1e6
+    return sorted(times.items(), key=lambda item: item[1], reverse=True)
+
+# Prints how long importing a module takes, broken down by package
+def print_import_report(module='main', top=15):
+    times = import_times(module)
+    total = sum(seconds for _, seconds in times)
+    print(f"Importing {module} took {total:.3f}s")
+    for package, seconds in times[:top]:
+        print(f"    {package:<24}{seconds:.3f}s")
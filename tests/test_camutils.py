@@ -0,0 +1,100 @@
+import datetime
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import numpy as np
+from src import camutils, dbutils, queueutils
+
+ALWAYS = datetime.time(0, 0) # Equal start and end times mean working all day
+
+# Plays a fixed list of frames, with the same interface as cv.VideoCapture
+class ScriptedCapture():
+    def __init__(self, frames):
+        self.frames = frames
+        self.index = -1
+
+    def isOpened(self):
+        return True
+
+    def grab(self):
+        self.index += 1
+        return self.index < len(self.frames)
+
+    def retrieve(self, image=None):
+        return True, self.frames[self.index].copy()
+
+    def release(self):
+        pass
+
+
+# Frames of a still scene and of movement, each moving frame differs a lot from the previous one
+def scripted_frames(pattern, shape=(48, 64, 3)):
+    rng = np.random.default_rng(0)
+    frames = []
+    for moving, n in pattern:
+        for _ in range(n):
+            frames.append(rng.integers(0, 256, shape, dtype=np.uint8) if moving else np.zeros(shape, dtype=np.uint8))
+    return frames
+
+
+class RunWindowTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        paths = mock.patch.multiple(dbutils, VIDEOS_PATH=self.folder.name + '/',
+                                    DATABASE_PATH=os.path.join(self.folder.name, 'database.csv'))
+        paths.start()
+        self.addCleanup(paths.stop)
+        self.addCleanup(self.folder.cleanup)
+
+    # Runs a camera on the frames and returns the lengths of the queued clips
+    def run_camera(self, frames, classifier=None):
+        clips = []
+        camera = camutils.Camera('scripted', dbutils.Database(), ALWAYS, ALWAYS, adaptive_threshold=False,
+                                 classifier=classifier or mock.Mock(), queue_policy=queueutils.BLOCK, queue_memory=None,
+                                 source_options={'open_capture': lambda url: ScriptedCapture(frames),
+                                                 'lossless': True, 'reconnect': False})
+        if classifier is None:
+            camera.process_frames = lambda frames, recording: (clips.append(len(frames)), recording.discard())
+        with mock.patch.object(camutils.cv, 'destroyAllWindows'):
+            camera.start(threading.Event())
+        return clips
+
+    def assert_no_recordings_left(self):
+        self.assertEqual([name for name in os.listdir(self.folder.name)
+                          if name.startswith(dbutils.RECORDING_PREFIX)], [])
+        self.assertEqual([thread for thread in threading.enumerate() if thread.name == 'video-writer'], [])
+
+    # Movement which starts again on the frame where a clip finishes extends the clip, nothing is lost
+    def test_trigger_when_clip_finishes(self):
+        for gap in (65, 66, 67):
+            with self.subTest(gap=gap):
+                clips = self.run_camera(scripted_frames([(False, 10), (True, 8), (False, gap), (True, 10)]))
+                # Every frame from the first movement to the end of the video is in a clip
+                self.assertGreaterEqual(sum(clips), 8 + gap + 10)
+                # and no unfinished recording is left behind
+                self.assert_no_recordings_left()
+
+    # A clip which fails to be classified discards its recording
+    def test_failed_clip(self):
+        classifier = mock.Mock()
+        classifier.classify_clip.side_effect = RuntimeError("broken model")
+        self.run_camera(scripted_frames([(False, 10), (True, 8), (False, 80)]), classifier)
+        self.assertEqual(classifier.classify_clip.call_count, 1)
+        self.assert_no_recordings_left()
+
+    # A clip which can't be queued any more is discarded
+    def test_queue_closed(self):
+        camera = camutils.Camera('scripted', dbutils.Database(), ALWAYS, ALWAYS, classifier=mock.Mock())
+        camera.clip_queue = queueutils.ClipQueue(1)
+        camera.clip_queue.close()
+        frames = scripted_frames([(True, 3)])
+        recording = camera.db.start_video(camera.fps, frames[0].shape)
+        recording.write(frames[0])
+        camera.queue_clip(np.stack(frames), recording)
+        self.assert_no_recordings_left()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from src import dbutils
+
+
+class DatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        paths = mock.patch.multiple(dbutils, VIDEOS_PATH=self.folder.name + '/',
+                                    DATABASE_PATH=os.path.join(self.folder.name, 'database.csv'))
+        paths.start()
+        self.addCleanup(paths.stop)
+        self.addCleanup(self.folder.cleanup)
+
+    # Records written by another database object, e.g. another process, after a compaction aren't lost
+    def test_write_after_other_compaction(self):
+        camera_db = dbutils.Database()
+        camera_db.delete_database()
+        camera_db.write_records([{'Unix time': 1, 'Date': 'N/A', 'Label': 'Fox'}])
+
+        other_db = dbutils.Database()
+        other_db.change_labels({1: 'Cat'})
+        other_db.compact()
+        camera_db.write_records([{'Unix time': 2, 'Date': 'N/A', 'Label': 'Fox'}])
+        camera_db.close()
+
+        records = dbutils.Database().read_records()
+        self.assertEqual([(int(record['Unix time']), record['Label']) for record in records], [(1, 'Cat'), (2, 'Fox')])
+
+    # Relabelling counts the changed records without building the edited records again
+    def test_change_labels_count(self):
+        db = dbutils.Database()
+        db.delete_database()
+        db.write_records([{'Unix time': unix_time, 'Date': 'N/A', 'Label': label}
+                          for unix_time, label in [(1, 'Fox'), (2, 'Fox'), (3, 'Cat')]])
+        db.read_rollups()
+        with mock.patch.object(dbutils.RecordColumns, 'with_edits', side_effect=AssertionError):
+            self.assertEqual(db.change_labels({1: 'Cat'}), 1)
+            self.assertEqual(db.change_labels({1: None, 4: 'Fox'}), 1)
+            self.assertEqual(db.change_labels({1: 'Fox'}), 0) # A deleted record stays deleted
+        columns = db.read_columns()
+        self.assertEqual(list(zip(columns.times.tolist(), columns.label_list())), [(2, 'Fox'), (3, 'Cat')])
+        db.read_rollups()
+        self.assertEqual(db.rollups.counts, dbutils.Rollups.from_columns(columns).counts)
+        db.close()
+
+    # Without loaded records or rollups a relabel doesn't read the database
+    def test_change_labels_unloaded(self):
+        dbutils.Database().delete_database()
+        db = dbutils.Database()
+        with mock.patch.object(db, 'read_tail', side_effect=AssertionError):
+            self.assertIsNone(db.change_labels({1: 'Cat'}))
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
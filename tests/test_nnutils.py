@@ -0,0 +1,20 @@
+import importlib
+import sys
+import unittest
+from unittest import mock
+import numpy as np
+
+
+class NNUtilsTest(unittest.TestCase):
+    # The ONNX runtime path doesn't need torch installed
+    def test_import_without_torch(self):
+        sys.modules.pop('src.nnutils', None)
+        with mock.patch.dict(sys.modules, {'torch': None}):
+            nnutils = importlib.import_module('src.nnutils')
+            batch = nnutils.preprocess([np.zeros((48, 64, 3), dtype=np.uint8)], (24, 24), 'crop', [0.5] * 3, [0.5] * 3)
+        self.assertEqual(batch.shape, (1, 3, 24, 24))
+        self.assertTrue(np.all(batch == -1))
+
+
+if __name__ == '__main__':
+    unittest.main()
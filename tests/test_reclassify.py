@@ -0,0 +1,26 @@
+import json
+import os
+import tempfile
+import unittest
+from src import camutils, reclassify
+
+
+class DefaultSettingsTest(unittest.TestCase):
+    # The command line uses the same crop and database as the program
+    def test_from_settings(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'settings.json')
+            with open(path, 'w') as file:
+                json.dump({'Camera crop': '50,0,10,20', 'Database backend': 'sqlite', 'Camera url': ''}, file)
+            defaults = reclassify.default_settings(path)
+        self.assertEqual(reclassify.parse_crop(defaults['Camera crop']), (50, 0, 10, 20))
+        self.assertEqual(defaults['Database backend'], 'sqlite')
+
+    def test_without_settings(self):
+        defaults = reclassify.default_settings(os.path.join(tempfile.gettempdir(), 'missing settings.json'))
+        self.assertEqual(reclassify.parse_crop(defaults['Camera crop']), camutils.DEFAULT_CROP)
+        self.assertEqual(defaults['Database backend'], 'csv')
+
+
+if __name__ == '__main__':
+    unittest.main()